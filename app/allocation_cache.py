@@ -0,0 +1,87 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from record_cache import cache_key, project_prefix
+
+
+logger = logging.getLogger("redcap-utils")
+
+ALLOC_CACHE_ENABLED = os.getenv("ALLOC_CACHE_ENABLED", "1") == "1"
+ALLOC_CACHE_MAX_ENTRIES = int(os.getenv("ALLOC_CACHE_MAX_ENTRIES", "100000"))
+
+# (raw_value, label, event_name)
+Allocation = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+class AllocationCache:
+    """
+    In-memory LRU of randomization results. An allocation never changes once
+    it is set, so entries have no TTL; participants not randomized yet are
+    never stored and are looked up again next time.
+    """
+
+    def __init__(self, max_entries: int = ALLOC_CACHE_MAX_ENTRIES, enabled: bool = ALLOC_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, Allocation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, url: str, token: str, record_ids: Iterable[str]) -> Dict[str, Allocation]:
+        """Cached allocations for the given record ids (missing ids are left out)."""
+        found: Dict[str, Allocation] = {}
+        if not self.enabled:
+            return found
+        with self._lock:
+            for rid in record_ids:
+                key = cache_key(url, token, rid)
+                value = self._entries.get(key)
+                if value is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                found[rid] = value
+        return found
+
+    def get(self, url: str, token: str, record_id: str) -> Optional[Allocation]:
+        return self.get_many(url, token, [record_id]).get(record_id)
+
+    def set(self, url: str, token: str, record_id: str, value: Allocation):
+        if not self.enabled or value[0] is None:
+            return
+        with self._lock:
+            key = cache_key(url, token, record_id)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url: Optional[str] = None, token: Optional[str] = None) -> int:
+        """Drop one project's allocations, or every entry when no project is given."""
+        with self._lock:
+            if url is None:
+                n = len(self._entries)
+                self._entries.clear()
+                return n
+            prefix = project_prefix(url, token)
+            keys = [k for k in self._entries if k.startswith(prefix)]
+            for k in keys:
+                del self._entries[k]
+            return len(keys)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+allocation_cache = AllocationCache()
@@ -0,0 +1,121 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+CODED_FIELD_TYPES = frozenset({"dropdown", "radio", "checkbox", "yesno", "truefalse"})
+
+# REDCap does not store choices for these types; they are implied.
+IMPLIED_CHOICES = {
+    "yesno": "1, Yes | 0, No",
+    "truefalse": "1, True | 0, False",
+}
+
+
+def normalize_label(s: str) -> str:
+    return s.lower().replace(" ", "").replace("_", "").replace("-", "")
+
+
+def parse_choices(choices: str) -> List[Tuple[str, str]]:
+    """Split a 'code, label | code, label' string into (code, label) pairs."""
+    out = []
+    for part in (choices or "").split("|"):
+        part = part.strip()
+        if "," not in part:
+            continue
+        code, label = part.split(",", 1)
+        out.append((code.strip(), label.strip()))
+    return out
+
+
+def checkbox_column(field_name: str, code: str) -> str:
+    """Export column name REDCap uses for one checkbox option, e.g. field___1."""
+    return f"{field_name}___{code.lower().replace('-', '_')}"
+
+
+class FieldChoices:
+    """Lookup tables for one coded field."""
+
+    __slots__ = ("field_name", "field_type", "pairs", "code_to_label",
+                 "_by_code", "_by_label", "_by_norm")
+
+    def __init__(self, field_name: str, field_type: str, pairs: List[Tuple[str, str]]):
+        self.field_name = field_name
+        self.field_type = field_type
+        self.pairs = pairs
+        self.code_to_label = {code: label for code, label in pairs}
+        self._by_code = {code.lower(): code for code, _ in pairs}
+        self._by_label = {label.lower(): code for code, label in pairs}
+        self._by_norm = {normalize_label(label): code for code, label in pairs}
+
+    def code_for(self, value: str) -> Optional[str]:
+        """Resolve a raw code, label or loosely-written label to its code."""
+        v = value.strip().lower()
+        code = self._by_code.get(v)
+        if code is None:
+            code = self._by_label.get(v)
+        if code is None:
+            code = self._by_norm.get(normalize_label(v))
+        return code
+
+    def choices_string(self) -> str:
+        return " | ".join(f"{code}, {label}" for code, label in self.pairs)
+
+
+class ChoiceIndex:
+    """
+    Choice lookups for every coded field in a data dictionary, built once per
+    metadata version and shared by all callers.
+    """
+
+    def __init__(self, metadata: Iterable[Dict[str, Any]]):
+        self.fields: Dict[str, FieldChoices] = {}
+        # checkbox export column -> (field_name, code, label)
+        self.checkbox_columns: Dict[str, Tuple[str, str, str]] = {}
+
+        for m in metadata:
+            field_type = m.get("field_type")
+            if field_type not in CODED_FIELD_TYPES:
+                continue
+            name = m["field_name"]
+            choices = IMPLIED_CHOICES.get(field_type) or m.get("select_choices_or_calculations", "")
+            fc = FieldChoices(name, field_type, parse_choices(choices))
+            self.fields[name] = fc
+            if field_type == "checkbox":
+                for code, label in fc.pairs:
+                    self.checkbox_columns[checkbox_column(name, code)] = (name, code, label)
+
+    def get(self, field_name: str) -> Optional[FieldChoices]:
+        return self.fields.get(field_name)
+
+    def choice_map(self, field_name: str) -> Dict[str, str]:
+        fc = self.fields.get(field_name)
+        return fc.code_to_label if fc is not None else {}
+
+    def label(self, field_name: str, code: Any) -> Optional[str]:
+        fc = self.fields.get(field_name)
+        return fc.code_to_label.get(str(code)) if fc is not None else None
+
+    def code(self, field_name: str, value: str) -> Optional[str]:
+        fc = self.fields.get(field_name)
+        return fc.code_for(value) if fc is not None else None
+
+    def decode_record(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Translate one raw exported row to labels in a single pass. Coded values
+        become their labels; checked checkbox columns are folded into a list of
+        labels under the base field name; unchecked ones are dropped.
+        """
+        out: Dict[str, Any] = {}
+        fields = self.fields
+        checkbox_columns = self.checkbox_columns
+        for key, value in row.items():
+            cb = checkbox_columns.get(key)
+            if cb is not None:
+                if value in ("1", 1):
+                    out.setdefault(cb[0], []).append(cb[2])
+                continue
+            fc = fields.get(key)
+            if fc is not None and value != "":
+                out[key] = fc.code_to_label.get(str(value), value)
+            else:
+                out[key] = value
+        return out
@@ -0,0 +1,131 @@
+"""
+Response compression negotiated on Accept-Encoding: zstd or gzip. zstd
+needs the `zstandard` package (in requirements.txt); without it only gzip
+is offered. Bodies under COMPRESS_MIN_BYTES are sent as-is; streamed bodies
+(NDJSON) are compressed chunk by chunk and flushed so clients still see each
+line as it is produced.
+"""
+import os
+import zlib
+from typing import List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # e.g. a minimal install without it
+    zstandard = None
+
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "5"))
+COMPRESS_ZSTD_LEVEL = int(os.getenv("COMPRESS_ZSTD_LEVEL", "3"))
+
+# Server preference when the client weights encodings equally
+SUPPORTED = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+
+def negotiate(accept_encoding: str, supported=SUPPORTED) -> Optional[str]:
+    """Best supported coding for an Accept-Encoding header, or None for identity."""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _Encoder:
+    def __init__(self, coding: str):
+        if coding == "zstd":
+            self._c = zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._c = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._c.compress(data) + self._c.flush(self._flush_mode)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._c.compress(data) + self._c.flush()
+
+
+def compress(data: bytes, coding: str) -> bytes:
+    """One-shot compression, e.g. for bodies cached in their encoded form."""
+    return _Encoder(coding).finish(data)
+
+
+def _headers_without(headers: List[Tuple[bytes, bytes]], *names: bytes) -> List[Tuple[bytes, bytes]]:
+    return [(k, v) for k, v in headers if k.lower() not in names]
+
+
+class CompressionMiddleware:
+    """ASGI middleware; skips responses that are already encoded, 1xx/204/304, or small."""
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        coding = negotiate(accept) if accept else None
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        encoder: Optional[_Encoder] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                if message["status"] in (204, 304) or message["status"] < 200 or \
+                        any(k.lower() == b"content-encoding" for k, _ in headers):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if encoder is None:
+                headers = start.get("headers", [])
+                if not more and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send({**start, "headers": headers + [(b"vary", b"Accept-Encoding")]})
+                    await send(message)
+                    return
+                encoder = _Encoder(coding)
+                headers = _headers_without(headers, b"content-length") + [
+                    (b"content-encoding", coding.encode()), (b"vary", b"Accept-Encoding")]
+                if not more:
+                    data = encoder.finish(body)
+                    headers.append((b"content-length", str(len(data)).encode()))
+                    await send({**start, "headers": headers})
+                    await send({"type": "http.response.body", "body": data})
+                    return
+                await send({**start, "headers": headers})
+
+            data = encoder.chunk(body) if more else encoder.finish(body)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_wrapper)
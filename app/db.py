@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from timing import timed
+
+# motor/pymongo are imported in open_mongo(), so they are only loaded when
+# MONGODB_URI is configured.
+ASCENDING, DESCENDING = 1, -1
+
+
+logger = logging.getLogger("redcap-utils")
+
+MONGODB_URI = os.getenv("MONGODB_URI")
+MONGODB_DB = os.getenv("MONGODB_DB", "meliora_dev_rct")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_TIMEOUT_MS = int(os.getenv("MONGODB_TIMEOUT_MS", "5000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "20000"))
+# Optional projection for /get-user-action-plans (comma-separated field
+# names); unset returns whole documents
+ACTION_PLAN_FIELDS = [f.strip() for f in os.getenv("ACTION_PLAN_FIELDS", "").split(",") if f.strip()]
+
+RESPONSE_KEY_INDEX = [("record_id", ASCENDING), ("event_unique", ASCENDING), ("snapshot.instrument", ASCENDING)]
+
+
+class MongoStore:
+    """Async (Motor) access to the UserProfile and RedcapResponses collections."""
+
+    def __init__(self, client, db_name: str = MONGODB_DB):
+        self.client = client
+        self.db = client[db_name]
+        self.user_profiles = self.db["UserProfile"]
+        self.responses = self.db["RedcapResponses"]
+
+    async def ensure_indexes(self):
+        # The compound index also serves userId-only lookups (prefix)
+        await self.user_profiles.create_index([("userId", ASCENDING), ("createdAt", DESCENDING)],
+                                              name="userId_createdAt")
+        await self.responses.create_index(RESPONSE_KEY_INDEX, unique=True, name="redcap_response_key")
+        await self.responses.create_index([("userId", ASCENDING)], name="userId")
+        await self.responses.create_index([("createdAt", DESCENDING)], name="createdAt")
+
+    async def ping(self) -> int:
+        t0 = time.monotonic()
+        with timed("mongo_ping"):
+            await self.client.admin.command("ping")
+        return int((time.monotonic() - t0) * 1000)
+
+    async def collection_names(self) -> List[str]:
+        return sorted(await self.db.list_collection_names())
+
+    async def find_action_plans(self, user_id: str) -> List[Dict[str, Any]]:
+        projection = {f: 1 for f in ACTION_PLAN_FIELDS} or None
+        cursor = self.user_profiles.find({"userId": user_id}, projection).sort("createdAt", DESCENDING)
+        plans = []
+        with timed("mongo_find_action_plans"):
+            async for plan in cursor:
+                plan["_id"] = str(plan["_id"])
+                plans.append(plan)
+        return plans
+
+    async def list_user_ids(self) -> List[str]:
+        cursor = self.user_profiles.find({}, {"_id": 0, "userId": 1})
+        with timed("mongo_list_user_ids"):
+            return [doc["userId"] async for doc in cursor if doc.get("userId")]
+
+    async def get_category(self, user_id: str) -> Optional[str]:
+        with timed("mongo_get_category"):
+            doc = await self.user_profiles.find_one({"userId": user_id}, {"_id": 0, "category": 1})
+        return doc.get("category") if doc else None
+
+
+mongo: Optional[MongoStore] = None
+
+
+async def open_mongo() -> Optional[MongoStore]:
+    """Create the Motor client and bootstrap indexes (called from the app lifespan)."""
+    global mongo
+    if not MONGODB_URI:
+        logger.info("MONGODB_URI not set; Mongo endpoints are disabled")
+        return None
+    if mongo is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(
+            MONGODB_URI,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS,
+            connectTimeoutMS=MONGODB_TIMEOUT_MS,
+            socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS,
+        )
+        mongo = MongoStore(client)
+        try:
+            await mongo.ensure_indexes()
+        except Exception as e:
+            # Index bootstrap must not keep the API from starting
+            logger.warning(f"Mongo index bootstrap failed: {e}")
+        logger.info(f"Mongo client opened (db={MONGODB_DB}, maxPoolSize={MONGODB_MAX_POOL_SIZE})")
+    return mongo
+
+
+def close_mongo():
+    global mongo
+    if mongo is not None:
+        mongo.client.close()
+        mongo = None
+        logger.info("Mongo client closed")
@@ -0,0 +1,281 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import timing
+
+
+logger = logging.getLogger("redcap-utils")
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+INGEST_FLUSH_INTERVAL_S = float(os.getenv("INGEST_FLUSH_INTERVAL_S", "0.5"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "3"))
+INGEST_RETRY_BASE_S = float(os.getenv("INGEST_RETRY_BASE_S", "0.1"))
+
+# Server error codes worth retrying: the write may succeed on the next attempt.
+# 11000 is included because concurrent upserts on a unique index can race.
+TRANSIENT_WRITE_CODES = frozenset({
+    6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11000, 11600, 11602, 13435, 13436,
+})
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+def _transient_write_error(error: Dict[str, Any]) -> bool:
+    return error.get("code") in TRANSIENT_WRITE_CODES or "RetryableWriteError" in error.get("errorLabels", ())
+
+
+def response_key(payload) -> Tuple[str, str, str]:
+    return (payload.record_id, payload.event_unique, payload.snapshot.instrument)
+
+
+def build_response_upsert(payload, timestamp: datetime) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(filter, update) for one RedcapResponsePayload snapshot."""
+    now_dt = datetime.now(timezone.utc)
+
+    # Composite uniqueness key (prevents duplicates for the same user/event/instrument)
+    filter_q = {
+        "record_id": payload.record_id,
+        "event_unique": payload.event_unique,
+        "snapshot.instrument": payload.snapshot.instrument,
+    }
+    set_doc = {
+        "project_id": payload.project_id,
+        "project_title": payload.project_title,
+        "record_id": payload.record_id,
+        "userId": payload.record_id,  # convenience alias
+        "event_id": payload.event_id,
+        "event_unique": payload.event_unique,
+        "event_label": payload.event_label,
+        "dag": payload.dag,
+        "instrument_language": payload.instrument_language,
+        "timestamp": timestamp,                   # BSON Date
+        "snapshot": payload.snapshot.model_dump(),  # instrument + answers[]
+        "updatedAt": now_dt,
+    }
+    return filter_q, {"$set": set_doc, "$setOnInsert": {"createdAt": now_dt}}
+
+
+_STOP = object()
+
+
+class _Item:
+    __slots__ = ("key", "filter", "update", "future")
+
+    def __init__(self, key, filter_q, update, future):
+        self.key = key
+        self.filter = filter_q
+        self.update = update
+        self.future = future
+
+
+class ResponseIngestor:
+    """
+    Buffers response upserts in an in-process queue and writes them to a Motor
+    collection with one unordered bulk_write per batch, flushing when
+    `batch_size` items are waiting or `flush_interval` seconds after the first
+    one arrived. Updates to the same key within a batch are coalesced (last
+    one wins).
+    """
+
+    def __init__(self, collection, batch_size: int = INGEST_BATCH_SIZE,
+                 flush_interval: float = INGEST_FLUSH_INTERVAL_S, max_queue: int = INGEST_QUEUE_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.retries = 0
+        self.max_batch = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    async def start(self):
+        # The unique response-key index is bootstrapped by db.open_mongo()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        logger.info(f"Response ingestor started (batch_size={self.batch_size}, "
+                    f"flush_interval={self.flush_interval}s)")
+
+    async def stop(self):
+        """Flush whatever is queued, then stop the flusher."""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        logger.info("Response ingestor stopped")
+
+    def submit(self, key, filter_q, update) -> asyncio.Future:
+        """Queue one upsert; the returned future resolves to 'inserted'/'updated' after its flush."""
+        future = asyncio.get_running_loop().create_future()
+        # Fire-and-forget callers never await the future; don't let a failed
+        # flush surface as "exception was never retrieved".
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            self._queue.put_nowait(_Item(key, filter_q, update, future))
+        except asyncio.QueueFull:
+            raise IngestQueueFull(f"ingest queue is full ({self._queue.maxsize} items)")
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Never let one bad batch stop the flusher
+                logger.exception(f"Response ingest flush of {len(batch)} items failed")
+                self._settle(batch, error=e)
+
+    def _settle(self, items: List[_Item], result: Any = None, error: Optional[Exception] = None):
+        """Resolve the futures of `items` (one coalesced key) with a result or an error."""
+        for item in items:
+            if item.future.done():
+                continue
+            if error is not None:
+                item.future.set_exception(error)
+                self.errors += 1
+            else:
+                item.future.set_result(result)
+
+    async def _flush(self, batch: List[_Item]):
+        """
+        Write a batch as one unordered bulk_write. Per-op failures reported in
+        BulkWriteError.details are resolved on their own items; transient ones
+        (and whole-batch network errors) are retried up to INGEST_MAX_RETRIES
+        times with backoff, while the ops that succeeded are never re-sent.
+        """
+        if not batch:
+            return
+        from pymongo import UpdateOne
+        from pymongo.common import validate_is_mapping, validate_ok_for_update
+        from pymongo.errors import BulkWriteError, ConnectionFailure, WriteError
+
+        items_by_key: Dict[Any, List[_Item]] = defaultdict(list)
+        for item in batch:
+            items_by_key[item.key].append(item)
+        # Later updates to a key within the batch win
+        latest = {key: items[-1] for key, items in items_by_key.items()}
+
+        pending = list(latest)
+        n_ops = 0
+        errors_before = self.errors
+        t0 = time.perf_counter()
+        for attempt in range(INGEST_MAX_RETRIES + 1):
+            keys, ops = [], []
+            for key in pending:
+                item = latest[key]
+                try:
+                    # bulk_write would only validate these when encoding the
+                    # whole batch; check up front so a malformed update fails
+                    # its own items only
+                    validate_is_mapping("filter", item.filter)
+                    validate_ok_for_update(item.update)
+                    ops.append(UpdateOne(item.filter, item.update, upsert=True))
+                except Exception as e:
+                    self._settle(items_by_key[key], error=e)
+                    continue
+                keys.append(key)
+            if not ops:
+                break
+            n_ops += len(ops)
+            last_attempt = attempt == INGEST_MAX_RETRIES
+
+            write_errors: Dict[int, Dict[str, Any]] = {}
+            try:
+                result = await self.collection.bulk_write(ops, ordered=False)
+                upserted = set(result.upserted_ids)
+            except BulkWriteError as e:
+                details = e.details or {}
+                write_errors = {err["index"]: err for err in details.get("writeErrors", [])}
+                upserted = {u["index"] for u in details.get("upserted", [])}
+                if details.get("writeConcernErrors"):
+                    logger.warning(f"Response ingest write concern errors: {details['writeConcernErrors']}")
+            except ConnectionFailure as e:
+                # Network error / primary unavailable: nothing is known about the batch, retry all of it
+                if last_attempt:
+                    for key in keys:
+                        self._settle(items_by_key[key], error=e)
+                    break
+                logger.warning(f"Response ingest flush of {len(ops)} ops failed, retrying: {e!r}")
+                self.retries += len(keys)
+                pending = keys
+                await asyncio.sleep(INGEST_RETRY_BASE_S * 2 ** attempt)
+                continue
+            except Exception as e:
+                logger.exception(f"Response ingest flush of {len(ops)} ops failed")
+                for key in keys:
+                    self._settle(items_by_key[key], error=e)
+                break
+
+            retry = []
+            for i, key in enumerate(keys):
+                err = write_errors.get(i)
+                if err is None:
+                    self._settle(items_by_key[key], "inserted" if i in upserted else "updated")
+                elif _transient_write_error(err) and not last_attempt:
+                    retry.append(key)
+                else:
+                    logger.error(f"Response upsert for {key} failed: {err.get('errmsg')} (code {err.get('code')})")
+                    self._settle(items_by_key[key],
+                                 error=WriteError(err.get("errmsg", "write error"), err.get("code"), err))
+            if not retry:
+                break
+            logger.warning(f"Retrying {len(retry)} of {len(ops)} response upserts after transient write errors")
+            self.retries += len(retry)
+            pending = retry
+            await asyncio.sleep(INGEST_RETRY_BASE_S * 2 ** attempt)
+
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        failed = self.errors - errors_before
+        timing.record("mongo_bulk_write", elapsed_ms / 1000, error=failed == len(batch))
+
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.last_flush_ms = elapsed_ms
+        self.total_flush_ms += elapsed_ms
+        logger.info(f"Flushed {len(batch)} responses as {n_ops} upserts in {elapsed_ms:.1f} ms"
+                    + (f" ({failed} failed)" if failed else ""))
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+            "errors": self.errors,
+            "retries": self.retries,
+            "max_batch": self.max_batch,
+            "avg_batch": round(self.items / self.batches, 1) if self.batches else 0.0,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "avg_flush_ms": round(self.total_flush_ms / self.batches, 1) if self.batches else 0.0,
+        }
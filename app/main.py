@@ -1,28 +1,52 @@
+import time
+_import_started = time.perf_counter()
+
 import os
+import io
+import csv
+import sys
 import json
-import time
+import asyncio
 from uuid import uuid4
 from datetime import datetime
 from pathlib import Path
-import httpx
 import logging
+from contextlib import asynccontextmanager
 from typing import Optional, Literal, Any, List, Dict
 
-from b4u_utils import api_url, export_record_with_labels, connect_to_project
-
-from utils import *
+from b4u_utils import (api_url, export_record_with_labels_async,
+                       export_records_with_labels_batch, stream_records_with_labels,
+                       fetch_record_with_metadata, iter_labelled_instances, label_records_columnar,
+                       record_exports, projection_key, REDCAP_EXPORT_CHUNK_SIZE)
+from redcap_registry import registry
+from metadata_cache import metadata_cache
+from project_structure import structure_cache
+from allocation_cache import allocation_cache
+import redcap_async
+import timing
+from record_cache import record_cache, cache_key, body_etag, open_record_cache
+from compression import CompressionMiddleware, COMPRESS_MIN_BYTES, negotiate
+from serialization import FastJSONResponse, dumps
+from warmup import warmup
+from redcap_async import get_redcap_client
+
+from utils import ENROL_BATCH_SIZE, HEALTH_FIELD, ALLOC_FIELD, create_records_bulk, get_randomization_groups
 from utils import _date_only_date, _parse_iso_datetime, _serialize_response_doc
 
-from fastapi import FastAPI, Query, Body
+from fastapi import FastAPI, Query, Body, Header, Request
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import secrets
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field, field_validator
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+
+import db
+from webhook_queue import open_webhook_queue, close_webhook_queue
+from outbound import CircuitOpenError, open_engine as outbound_engine, close_engine as close_outbound_engine
+
+from ingest import ResponseIngestor, IngestQueueFull, build_response_upsert, response_key
 
 
 # Configure Logging
@@ -33,11 +57,16 @@ logging.basicConfig(
 logger = logging.getLogger("redcap-utils")
 
 # --- Security setup ---
-security = HTTPBasic()
+# auto_error=False so the probe routes below can be reached without credentials
+security = HTTPBasic(auto_error=False)
 
 # Credentials from environment variables
 BASIC_AUTH_USER = os.getenv("API_USER", "admin")
 BASIC_AUTH_PASS = os.getenv("API_PASS", "changeme")
+# Load balancer / k8s readiness probes and Prometheus scrapes carry no
+# credentials; METRICS_AUTH=1 puts /metrics behind Basic auth again
+METRICS_AUTH = os.getenv("METRICS_AUTH", "0") == "1"
+PUBLIC_ROUTES = {"/ready"} | (set() if METRICS_AUTH else {"/metrics"})
 
 # --- CONFIGURATION ---
 REDCAP_API_URL = os.getenv("BASE_URL")
@@ -45,11 +74,74 @@ REDCAP_API_TOKEN = os.getenv("API_TOKEN")
 
 # ---- Config for forwarding (set in env when deployed) ----
 FORWARD_URL = os.getenv("FORWARD_URL")  # e.g. "https://other-service/api/ingest"
-# FORWARD_TIMEOUT_S = float(os.getenv("FORWARD_TIMEOUT_S", "10"))
 FORWARD_ENABLED = os.getenv("FORWARD_ENABLED", "0") == "1"
 
 
-def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Cached records whose JSON body is larger than this are streamed line by
+# line as NDJSON instead of being held a second time as one encoded body
+NDJSON_BUFFER_MAX_BYTES = int(os.getenv("NDJSON_BUFFER_MAX_BYTES", str(1024 * 1024)))
+
+
+def _split_csv(values: Optional[List[str]]) -> Optional[List[str]]:
+    # ?fields=a&fields=b and ?fields=a,b are equivalent
+    if not values:
+        return None
+    return [v.strip() for value in values for v in value.split(",") if v.strip()] or None
+
+
+def _variant_etag(etag: str, variant: str) -> str:
+    # Different representations of the same data (json / ndjson) get different tags
+    return f'{etag[:-1]}-{variant}"' if variant else etag
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Weak comparison (RFC 9110 13.1.2)
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == tag for t in if_none_match.split(","))
+
+
+def _ndjson_line(obj) -> bytes:
+    return dumps(obj) + b"\n"
+
+
+def _encoded_response(entry, variant: str, media_type: str, accept_encoding: Optional[str],
+                      headers: Dict[str, str]) -> Response:
+    # Cached entries keep their encoded (and compressed) bodies, so a hit
+    # costs no JSON encoding and no compression; the compression middleware
+    # passes responses that already carry Content-Encoding through.
+    body = entry.encoded(variant)
+    coding = negotiate(accept_encoding) if accept_encoding and len(body) >= COMPRESS_MIN_BYTES else None
+    if coding is not None:
+        body = entry.encoded(variant, coding)
+        headers = {**headers, "Content-Encoding": coding, "Vary": "Accept-Encoding"}
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+async def _ndjson_stream(instances):
+    # Accepts sync or async iterables of JSON-serializable objects
+    if hasattr(instances, "__aiter__"):
+        async for obj in instances:
+            yield _ndjson_line(obj)
+    else:
+        for obj in instances:
+            yield _ndjson_line(obj)
+
+
+def get_current_username(request: Request, credentials: Optional[HTTPBasicCredentials] = Depends(security)):
+    route = request.scope.get("route")
+    if route is not None and route.path in PUBLIC_ROUTES:
+        return None
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Basic"},
+        )
     correct_username = secrets.compare_digest(credentials.username, BASIC_AUTH_USER)
     correct_password = secrets.compare_digest(credentials.password, BASIC_AUTH_PASS)
     if not (correct_username and correct_password):
@@ -61,6 +153,44 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
     return credentials.username
 
 
+# Optional/heavy dependencies are imported by the subsystem that needs them
+# (PyCap on the first sync Project, motor/pymongo when MONGODB_URI is set,
+# sqlalchemy for sync/persistence; pandas should never be loaded); this reports which
+# of them a worker actually ended up loading.
+HEAVY_MODULES = ("pandas", "redcap", "requests", "pymongo", "motor", "httpx", "sqlalchemy")
+startup: Dict[str, Any] = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    t0 = time.perf_counter()
+    redcap_async.open_http()
+    # Not awaited: the worker starts serving while caches fill; /ready gates traffic
+    warmup.start(lambda: get_redcap_client(api_url(REDCAP_API_URL), REDCAP_API_TOKEN),
+                 (HEALTH_FIELD, ALLOC_FIELD))
+    open_record_cache()
+    global ingestor
+    store = await db.open_mongo()
+    if store is not None:
+        ingestor = ResponseIngestor(store.responses)
+        await ingestor.start()
+    await open_webhook_queue().start(handle_completed_user)
+    startup["lifespan_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    startup["loaded_modules"] = [m for m in HEAVY_MODULES if m in sys.modules]
+    logger.info(f"Startup: imports {startup['import_ms']} ms, lifespan {startup['lifespan_ms']} ms, "
+                f"loaded {startup['loaded_modules']}")
+    yield
+    await warmup.stop()
+    await close_webhook_queue()
+    if ingestor is not None:
+        await ingestor.stop()
+        ingestor = None
+    db.close_mongo()
+    await close_outbound_engine()
+    await redcap_async.close_http()
+    registry.close()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="B4U REDCap Utilities API",
@@ -89,7 +219,9 @@ app = FastAPI(
             "description": "Localhost testing"
         },
     ],
-    dependencies=[Depends(get_current_username)]
+    dependencies=[Depends(get_current_username)],
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
 )
 
 origins = [
@@ -104,27 +236,34 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+# Outermost, so the measured time covers CORS and the full (streamed) body
+app.add_middleware(timing.RequestTimingMiddleware)
+
+# MongoDB: the Motor client is opened in the lifespan (db.open_mongo) and is
+# only available when MONGODB_URI is set.
+ingestor: Optional[ResponseIngestor] = None
 
-# MongoDB setup
-# client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
-# client = MongoClient(os.getenv("MONGODB_URI"))
-# db = client["meliora_dev_rct"]
-# collection = db["UserProfile"]
-# responses_col = db["RedcapResponses"]
+
+def require_mongo() -> db.MongoStore:
+    if db.mongo is None:
+        raise HTTPException(status_code=503, detail="MongoDB is not configured (MONGODB_URI)")
+    return db.mongo
 
 
 # ==== Models ====
 # class UpdateUserProfile(BaseModel):
 #     userId: str
 #     isControl: bool
-#
-#
-# class CreateRecordRequest(BaseModel):
-#     userId: str
-#     health_status: str
-#     country_code: str
-#
-#
+
+
+
+class CreateRecordRequest(BaseModel):
+    userId: str
+    health_status: str
+    country_code: str
+
+
 # class CreateRecordResponse(BaseModel):
 #     userId: str
 #     status: Literal["success", "error"]
@@ -142,69 +281,130 @@ app.add_middleware(
 #     allocation_field: str
 #     allocation: str
 #     timestamp: str
-#
-# class ForwardUserResponse(BaseModel):
-#     status: Literal["received", "forwarded", "error"]
-#     userId: str
-#     category: Optional[str] = None
-#     upstream_status_code: Optional[int] = None
-#     upstream_body: Optional[Any] = None
-#
-# class AnswerItem(BaseModel):
-#     field_name: str
-#     field_label: Optional[str] = None
-#     value_raw: Optional[str] = None
-#     value_label: Optional[str] = None
-#     field_type: Optional[str] = None
-#
-#     @field_validator("value_raw", "value_label", mode="before")
-#     @classmethod
-#     def _coerce_to_str_or_none(cls, v: Any) -> Optional[str]:
-#         # Treat empty-like values as None
-#         if v in (None, "", [], {}):
-#             return None
-#         # If it's a list (e.g., checkboxes), join as comma-separated
-#         if isinstance(v, list):
-#             return ",".join(str(x) for x in v) if v else None
-#         # If it's a dict, store JSON
-#         if isinstance(v, dict):
-#             return json.dumps(v, ensure_ascii=False)
-#         # Everything else → string
-#         return str(v)
-#
-#
-# class Snapshot(BaseModel):
-#     instrument: str
-#     answers: List[AnswerItem] = Field(default_factory=list)
-#
-#
-# class RedcapResponsePayload(BaseModel):
-#     project_id: int
-#     project_title: str
-#     record_id: str
-#     event_id: int
-#     event_unique: str
-#     event_label: Optional[str] = None
-#     dag: Optional[str] = None
-#     instrument_language: str
-#     timestamp: str
-#     snapshot: Snapshot
+
+
+class ForwardUserResponse(BaseModel):
+    status: Literal["received", "forwarded", "error"]
+    userId: str
+    category: Optional[str] = None
+    upstream_status_code: Optional[int] = None
+    upstream_body: Optional[Any] = None
+
+
+class WebhookAck(BaseModel):
+    status: Literal["queued", "duplicate"]
+    job_id: int
+    userId: str
+
+
+class AnswerItem(BaseModel):
+    field_name: str
+    field_label: Optional[str] = None
+    value_raw: Optional[str] = None
+    value_label: Optional[str] = None
+    field_type: Optional[str] = None
+
+    @field_validator("value_raw", "value_label", mode="before")
+    @classmethod
+    def _coerce_to_str_or_none(cls, v: Any) -> Optional[str]:
+        # Treat empty-like values as None
+        if v in (None, "", [], {}):
+            return None
+        # If it's a list (e.g., checkboxes), join as comma-separated
+        if isinstance(v, list):
+            return ",".join(str(x) for x in v) if v else None
+        # If it's a dict, store JSON
+        if isinstance(v, dict):
+            return json.dumps(v, ensure_ascii=False)
+        # Everything else → string
+        return str(v)
+
+
+class Snapshot(BaseModel):
+    instrument: str
+    answers: List[AnswerItem] = Field(default_factory=list)
+
+
+class RedcapResponsePayload(BaseModel):
+    project_id: int
+    project_title: str
+    record_id: str
+    event_id: int
+    event_unique: str
+    event_label: Optional[str] = None
+    dag: Optional[str] = None
+    instrument_language: str
+    timestamp: str
+    snapshot: Snapshot
+
+
+class BatchResponsesRequest(BaseModel):
+    record_ids: Optional[List[str]] = Field(None, description="Explicit REDCap record_ids")
+    dag: Optional[str] = Field(None, description="Unique DAG name, e.g. 'greece'")
+    date_begin: Optional[datetime] = Field(None, description="Only records modified at/after this time")
+    date_end: Optional[datetime] = Field(None, description="Only records modified before this time")
+    chunk_size: int = Field(REDCAP_EXPORT_CHUNK_SIZE, ge=1, le=1000,
+                            description="Record ids per export_records call")
+
+    @field_validator("record_ids")
+    @classmethod
+    def _non_empty_ids(cls, v: Optional[List[str]]) -> Optional[List[str]]:
+        if v is not None and not v:
+            raise ValueError("record_ids must not be empty")
+        return v
+
+
+class BulkCreateRecordsRequest(BaseModel):
+    rows: List[CreateRecordRequest] = Field(..., min_length=1)
+    batch_size: int = Field(ENROL_BATCH_SIZE, ge=1, le=1000, description="Records per import_records call")
+
+
+class BulkRecordResult(BaseModel):
+    row: int
+    userId: str
+    status: Literal["success", "error"]
+    record_id: Optional[str] = None
+    message: Optional[str] = None
+
+
+class BulkCreateRecordsResponse(BaseModel):
+    created: int
+    failed: int
+    results: List[BulkRecordResult]
+
+
+class RandomizationLookupRequest(BaseModel):
+    record_ids: Optional[List[str]] = Field(None, description="Explicit REDCap record_ids")
+    dag: Optional[str] = Field(None, description="Unique DAG name, e.g. 'greece'")
+    chunk_size: int = Field(REDCAP_EXPORT_CHUNK_SIZE, ge=1, le=1000,
+                            description="Record ids per export_records call")
+
+    @field_validator("record_ids")
+    @classmethod
+    def _non_empty_ids(cls, v: Optional[List[str]]) -> Optional[List[str]]:
+        if v is not None and not v:
+            raise ValueError("record_ids must not be empty")
+        return v
+
+
+class Allocation(BaseModel):
+    raw: Optional[str] = None
+    label: Optional[str] = None
+    event_name: Optional[str] = None
+
 
 # ==== Endpoints ====
-# @app.get("/get-user-action-plans", summary="List all action plans for a user")
-# async def get_user_action_plans(userId: str):
-#     try:
-#         plans = collection.find({"userId": userId}).sort("createdAt", -1)
-#         result = []
-#         for plan in plans:
-#             plan["_id"] = str(plan["_id"])
-#             result.append(plan)
-#
-#         if not result:
-#             return JSONResponse(status_code=404, content={"message": "No action plans found"})
-#         return result
-#     except Exception as e:
-#         return JSONResponse(status_code=500, content={"message": str(e)})
+@app.get("/get-user-action-plans", summary="List all action plans for a user")
+async def get_user_action_plans(userId: str):
+    store = require_mongo()
+    try:
+        result = await store.find_action_plans(userId)
+
+        if not result:
+            return FastJSONResponse(status_code=404, content={"message": "No action plans found"})
+        return FastJSONResponse(result)
+    except Exception as e:
+        return FastJSONResponse(status_code=500, content={"message": str(e)})
 
 
 # @app.post(
@@ -233,6 +433,51 @@ app.add_middleware(
 #         )
 
 
+async def _bulk_enrol(rows: List[dict], batch_size: int) -> BulkCreateRecordsResponse:
+    try:
+        client = get_redcap_client(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+        results = await create_records_bulk(client, rows, batch_size=batch_size)
+    except Exception as e:
+        logger.exception("Error in bulk enrolment")
+        raise HTTPException(status_code=502, detail=str(e))
+    created = sum(1 for r in results if r["status"] == "success")
+    return BulkCreateRecordsResponse(created=created, failed=len(results) - created, results=results)
+
+
+@app.post(
+    "/create-records",
+    response_model=BulkCreateRecordsResponse,
+    summary="Enrol many participants with batched REDCap imports"
+)
+async def create_records(payload: BulkCreateRecordsRequest):
+    return await _bulk_enrol([row.model_dump() for row in payload.rows], payload.batch_size)
+
+
+@app.post(
+    "/create-records/csv",
+    response_model=BulkCreateRecordsResponse,
+    summary="Enrol participants from a CSV with userId,health_status,country_code columns"
+)
+async def create_records_csv(
+    body: str = Body(..., media_type="text/csv"),
+    batch_size: int = Query(ENROL_BATCH_SIZE, ge=1, le=1000, description="Records per import_records call"),
+):
+    reader = csv.DictReader(io.StringIO(body.lstrip("\ufeff")))
+    missing = {"userId", "health_status", "country_code"} - set(reader.fieldnames or [])
+    if missing:
+        raise HTTPException(status_code=400, detail=f"CSV is missing columns: {sorted(missing)}")
+    rows = list(reader)
+    if not rows:
+        raise HTTPException(status_code=400, detail="CSV has no rows")
+    return await _bulk_enrol(rows, batch_size)
+
+
+@app.get("/ready", summary="Readiness: 200 once metadata, DAG, event and choice caches are warm, else 503")
+async def readiness():
+    state = warmup.state()
+    return FastJSONResponse(status_code=200 if state["ready"] else 503, content=state)
+
+
 @app.get("/hello", summary="Hello World")
 async def hello_world():
     return {"message": "Hello, world!"}
@@ -241,248 +486,446 @@ async def hello_world():
 
 
 
-# @app.post("/store-redcap-responses", summary="Upsert a REDCap instrument response snapshot")
-# async def upsert_redcap_response(
-#     payload: RedcapResponsePayload,
-#     # username: str = Depends(get_current_username)  # uncomment if you secured routes
-# ):
-#     try:
-#         logger.info(f"Received /redcap-responses payload for record_id={payload.record_id}, "
-#                     f"event={payload.event_unique}, instrument={payload.snapshot.instrument}")
-#
-#         ts_dt = _parse_iso_datetime(payload.timestamp)  # BSON Date
-#         now_dt = datetime.now(timezone.utc)
-#
-#         # Composite uniqueness key (prevents duplicates for the same user/event/instrument)
-#         filter_q = {
-#             "record_id": payload.record_id,
-#             "event_unique": payload.event_unique,
-#             "snapshot.instrument": payload.snapshot.instrument,
-#         }
-#
-#         # Document fields to store/update
-#         set_doc = {
-#             "project_id": payload.project_id,
-#             "project_title": payload.project_title,
-#             "record_id": payload.record_id,
-#             "userId": payload.record_id,  # convenience alias (optional)
-#             "event_id": payload.event_id,
-#             "event_unique": payload.event_unique,
-#             "event_label": payload.event_label,
-#             "dag": payload.dag,
-#             "timestamp": ts_dt,                  # BSON Date
-#             "snapshot": payload.snapshot.dict(), # instrument + answers[]
-#             "updatedAt": now_dt,
-#         }
-#
-#         # Only on first insert
-#         set_on_insert = {
-#             "createdAt": now_dt,
-#         }
-#
-#         res = responses_col.update_one(
-#             filter_q,
-#             {"$set": set_doc, "$setOnInsert": set_on_insert},
-#             upsert=True
-#         )
-#
-#         status_str = "inserted" if res.upserted_id is not None else ("updated" if res.modified_count else "no_change")
-#
-#         return {
-#             "status": status_str,
-#             "key": {
-#                 "record_id": payload.record_id,
-#                 "event_unique": payload.event_unique,
-#                 "instrument": payload.snapshot.instrument
-#             }
-#         }
-#
-#     except ValueError as ve:
-#         logger.error(f"/redcap-responses validation error: {ve}")
-#         return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ve))
-#     except Exception as e:
-#         logger.exception("/redcap-responses unexpected error")
-#         return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+@app.post("/store-redcap-responses", summary="Upsert a REDCap instrument response snapshot")
+async def upsert_redcap_response(
+    payload: RedcapResponsePayload,
+    wait: bool = Query(True, description="Wait for the batch write and report inserted/updated; "
+                                         "false acknowledges as soon as the upsert is queued"),
+):
+    if ingestor is None:
+        raise HTTPException(status_code=503, detail="MongoDB is not configured (MONGODB_URI)")
+
+    logger.info(f"Received /redcap-responses payload for record_id={payload.record_id}, "
+                f"event={payload.event_unique}, instrument={payload.snapshot.instrument}")
+    try:
+        ts_dt = _parse_iso_datetime(payload.timestamp)  # BSON Date
+    except ValueError as ve:
+        logger.error(f"/redcap-responses validation error: {ve}")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ve))
+
+    filter_q, update = build_response_upsert(payload, ts_dt)
+    try:
+        future = ingestor.submit(response_key(payload), filter_q, update)
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    status_str = "queued"
+    if wait:
+        try:
+            status_str = await future
+        except Exception as e:
+            logger.exception("/redcap-responses bulk write failed")
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    return {
+        "status": status_str,
+        "key": {
+            "record_id": payload.record_id,
+            "event_unique": payload.event_unique,
+            "instrument": payload.snapshot.instrument
+        }
+    }
+
+
+@app.get("/store-redcap-responses/stats", summary="Batch sizes and flush latency of the response ingestor")
+async def ingest_stats():
+    if ingestor is None:
+        raise HTTPException(status_code=503, detail="MongoDB is not configured (MONGODB_URI)")
+    return ingestor.stats()
 
 
 @app.get("/get-redcap-responses", summary="List RedcapResponses for a record_id")
 async def list_redcap_responses(
     record_id: str = Query(..., description="REDCap record_id (e.g., 304 for example results)"),
+    format: Literal["json", "ndjson"] = Query("json", description="ndjson streams one instrument instance per line"),
+    layout: Literal["rows", "columns"] = Query("rows", description="columns returns {label: [values]} (json only)"),
+    refresh: bool = Query(False, description="Bypass the record cache and fetch from REDCap"),
+    fields: Optional[List[str]] = Query(None, description="Only these fields (repeat or comma-separate)"),
+    forms: Optional[List[str]] = Query(None, description="Only these instruments (repeat or comma-separate)"),
+    events: Optional[List[str]] = Query(None, description="Only these unique event names (longitudinal)"),
+    if_none_match: Optional[str] = Header(None, description="ETag from a previous response; 304 if unchanged"),
+    accept_encoding: Optional[str] = Header(None, include_in_schema=False),
 ):
+    fields, forms, events = _split_csv(fields), _split_csv(forms), _split_csv(events)
     try:
-        project = connect_to_project(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+        client = get_redcap_client(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+
+        if layout == "columns":
+            entry, records = await fetch_record_with_metadata(client, record_id, fields, forms, events)
+            columns = label_records_columnar(records, entry.field_labels, record_id)
+            with timing.timed("serialization"):
+                body = dumps(columns)
+            etag = _variant_etag(body_etag(body), "columns")
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+        # NDJSON is only served from the cache on a hit; misses and refreshes
+        # stream straight from the export so time to first byte and memory do
+        # not grow with the record (such responses are not cached)
+        entry, cache_status = await record_cache.get_or_load(
+            cache_key(client.url, client.token, record_id, projection_key(fields, forms, events)),
+            lambda: export_record_with_labels_async(client, record_id, fields, forms, events),
+            refresh=refresh,
+            load=format != "ndjson",
+        )
+        timing.incr("record_cache_lookups", result=cache_status)
+        if entry is None:
+            view, records = await fetch_record_with_metadata(client, record_id, fields, forms, events)
+            return StreamingResponse(
+                _ndjson_stream(iter_labelled_instances(records, view.field_labels, record_id)),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers={"X-Cache": cache_status},
+            )
+
+        etag = _variant_etag(entry.etag, "ndjson" if format == "ndjson" else "")
+        headers = {"X-Cache": cache_status, "Age": str(int(entry.age)), "ETag": etag}
+
+        if _etag_matches(if_none_match, etag):
+            # Unchanged since the client's copy: no body, no serialization
+            timing.incr("not_modified", route="/get-redcap-responses")
+            return Response(status_code=304, headers=headers)
+
+        with timing.timed("serialization"):
+            if format == "ndjson":
+                if len(entry.encoded()) > NDJSON_BUFFER_MAX_BYTES:
+                    return StreamingResponse(_ndjson_stream(entry.value), media_type=NDJSON_MEDIA_TYPE,
+                                             headers=headers)
+                return _encoded_response(entry, "ndjson", NDJSON_MEDIA_TYPE, accept_encoding, headers)
+            return _encoded_response(entry, "json", "application/json", accept_encoding, headers)
+
+    except ValueError as e:
+        # Unknown field/form in the projection
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error in /get-redcap-responses")
+        raise HTTPException(status_code=500, detail=str(e))
+
 
-        record_data = export_record_with_labels(project, record_id)
+@app.post("/record-cache/invalidate", summary="Drop cached /get-redcap-responses results")
+async def invalidate_record_cache(
+    record_id: Optional[str] = Query(None, description="Only this record; omit to clear everything"),
+):
+    key = cache_key(api_url(REDCAP_API_URL), REDCAP_API_TOKEN, record_id) if record_id else None
+    await record_cache.invalidate(key)
+    return {"status": "invalidated", "cache": record_cache.stats()}
+
+
+@app.post("/redcap-project/refresh",
+          summary="Rebuild the pooled REDCap Project and drop everything cached for it "
+                  "(DAG/event snapshot, metadata, record exports, allocations)")
+async def refresh_redcap_project():
+    url, token = api_url(REDCAP_API_URL), REDCAP_API_TOKEN
+    registry.refresh(url, token)
+    dropped = {
+        "structure": structure_cache.invalidate(url, token),
+        "metadata": metadata_cache.invalidate(url, token),
+        "records": await record_cache.invalidate_project(url, token),
+        "allocations": allocation_cache.invalidate(url, token),
+    }
+    return {"status": "refreshed", "dropped": dropped}
+
+
+@app.get("/timings", summary="Per-stage timings and per-route request percentiles recorded by this worker")
+async def get_timings():
+    return {
+        "startup": startup,
+        "stages": timing.snapshot(),
+        "routes": timing.route_snapshot(),
+        "coalescing": {"record_export": record_exports.stats(), "record_cache": record_cache.stats()["coalesced"],
+                       "metadata": metadata_cache.stats()["coalesced"]},
+    }
+
+
+@app.get("/metrics", summary="Stage/route latency histograms and counters (Prometheus text format)")
+async def metrics():
+    return PlainTextResponse(timing.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/metadata-cache/invalidate", summary="Drop cached REDCap metadata so the next request re-downloads it")
+async def invalidate_metadata_cache(
+    all_projects: bool = Query(False, description="Invalidate every cached project, not only the configured one"),
+):
+    if all_projects:
+        dropped = metadata_cache.invalidate()
+    else:
+        dropped = metadata_cache.invalidate(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+    return {"status": "invalidated", "dropped": dropped, "cache": metadata_cache.stats()}
 
-        return record_data
+
+@app.post("/get-redcap-responses/batch", summary="Labelled REDCap responses for many records, grouped by record_id")
+async def list_redcap_responses_batch(
+    payload: BatchResponsesRequest,
+    format: Literal["json", "ndjson"] = Query("json", description="ndjson streams one instrument instance per line"),
+):
+    if payload.record_ids is None and payload.dag is None and payload.date_begin is None:
+        raise HTTPException(status_code=400, detail="Provide record_ids, dag or date_begin")
+    try:
+        client = get_redcap_client(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+
+        if format == "ndjson":
+            instances = stream_records_with_labels(
+                client,
+                record_ids=payload.record_ids,
+                dag=payload.dag,
+                date_begin=payload.date_begin,
+                date_end=payload.date_end,
+                chunk_size=payload.chunk_size,
+            )
+            return StreamingResponse(_ndjson_stream(instances), media_type=NDJSON_MEDIA_TYPE)
+
+        return FastJSONResponse(await export_records_with_labels_batch(
+            client,
+            record_ids=payload.record_ids,
+            dag=payload.dag,
+            date_begin=payload.date_begin,
+            date_end=payload.date_end,
+            chunk_size=payload.chunk_size,
+        ))
 
     except Exception as e:
-        return HTTPException(status_code=500, detail=str(e))
+        logger.exception("Error in /get-redcap-responses/batch")
+        raise HTTPException(status_code=500, detail=str(e))
 
 
-# @app.get(
-#     "/list-user-ids",
-#     summary="Return all userIds in the UserProfile collection"
-# )
-# async def list_user_ids():
-#     try:
-#         cursor = collection.find({}, {"_id": 0, "userId": 1})
-#         user_ids = [doc["userId"] for doc in cursor if doc.get("userId")]
-#         return user_ids
-#
-#     except Exception as e:
-#         logger.exception("Error in /list-user-ids")
-#         return HTTPException(status_code=500, detail=str(e))
+@app.post("/randomization-groups", response_model=Dict[str, Allocation],
+          summary="ALLOC_FIELD allocation (raw + label) for many records or a whole DAG")
+async def randomization_groups(
+    payload: RandomizationLookupRequest,
+    use_cache: bool = Query(True, description="Serve already-known allocations from memory"),
+):
+    if payload.record_ids is None and payload.dag is None:
+        raise HTTPException(status_code=400, detail="Provide record_ids or dag")
+    try:
+        client = get_redcap_client(api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+        # Already {record_id: {raw, label, event_name}}; skip per-item model validation
+        return FastJSONResponse(await get_randomization_groups(
+            client,
+            record_ids=payload.record_ids,
+            dag=payload.dag,
+            chunk_size=payload.chunk_size,
+            use_cache=use_cache,
+        ))
+    except Exception as e:
+        logger.exception("Error in /randomization-groups")
+        raise HTTPException(status_code=500, detail=str(e))
 
-#
-# @app.get("/mongo-health", summary="Check MongoDB connectivity (ping + optional deep check)")
-# async def mongo_health(deep: bool = Query(True, description="Include DB/collections info")):
-#     t0 = time.monotonic()
-#     try:
-#         # Quick connectivity check (works with auth)
-#         client.admin.command("ping")
-#         latency_ms = int((time.monotonic() - t0) * 1000)
-#
-#         payload = {
-#             "status": "ok",
-#             "latency_ms": latency_ms,
-#             "host": str(client.HOST) if hasattr(client, "HOST") else None,
-#             "port": int(client.PORT) if hasattr(client, "PORT") else None,
-#             "db": db.name,
-#         }
-#
-#         if deep:
-#             # “Deep” but still light: list collections in the target DB
-#             payload["collections"] = sorted(db.list_collection_names())
-#             # Optionally add quick counts (fast, approximate):
-#             # try:
-#             #     payload["estimated_counts"] = {
-#             #         "UserProfile": db["UserProfile"].estimated_document_count(),
-#             #         "RedcapResponses": db["RedcapResponses"].estimated_document_count(),
-#             #     }
-#             # except Exception:
-#             #     # ignore if permissions don’t allow counts
-#             #     pass
-#
-#         return JSONResponse(status_code=200, content=payload)
-#
-#     except PyMongoError as e:
-#         raise HTTPException(
-#             status_code=500,
-#             detail={
-#                 "status": "error",
-#                 "message": "MongoDB ping failed",
-#                 "error": str(e),
-#             },
-#         )
-#     except Exception as e:
-#         raise HTTPException(
-#             status_code=500,
-#             detail={
-#                 "status": "error",
-#                 "message": "Unexpected error during MongoDB health check",
-#                 "error": str(e),
-#             },
-#         )
-#
-#
-# @app.post(
-#     "/redcap-completed-user",
-#     response_model=ForwardUserResponse,
-#     summary="Receive JSON, extract userId, forward only userId to external service"
-# )
-# async def forward_user_id(
-#     payload: Dict[str, Any] = Body(...),
-#     # payload: RedcapResponsePayload,
-#     username: str = Depends(get_current_username)
-# ):
-#     try:
-#         # ----------------------------
-#         # 1. Extract userId
-#         # ----------------------------
-#         user_id = payload.get("record_id")
-#         instrument_name = payload.get("instrument")
-#
-#         if not user_id:
-#             logger.error("Missing userId in incoming JSON")
-#             raise HTTPException(status_code=400, detail="Missing required field: userId")
-#
-#         logger.info(f"/redcap-complete-user received payload for userId={user_id}")
-#         logger.debug(f"Full payload: {json.dumps(payload, ensure_ascii=False)}")
-#
-#         SEND_REQUEST = False
-#
-#         doc = collection.find_one(
-#             {"userId": user_id},
-#             {"_id": 0, "category": 1}
-#         )
-#
-#         category = doc["category"]
-#
-#         logger.info(f"The group of user {user_id} is {category}.")
-#
-#         ###
-#         if instrument_name == "functionality_appreciation_scale_fas" and category in ["healthy", "HEALTHY"]:
-#             SEND_REQUEST = True
-#             logger.info("Will send upstream request.")
-#
-#         if (instrument_name == "edmonton_symptom_assessment_system_revised_esasr" and
-#                 category not in ["healthy", "HEALTHY"]):
-#             SEND_REQUEST = True
-#             logger.info("Will send upstream request.")
-#
-#         # ----------------------------
-#         # 2. Build outbound payload
-#         # ----------------------------
-#         outbound = {"userId": user_id}
-#
-#         # ----------------------------
-#         # 3. Forward if enabled
-#         # ----------------------------
-#
-#         target_url = f"{FORWARD_URL}/users/{user_id}/status/today"
-#
-#         will_forward = SEND_REQUEST and FORWARD_ENABLED
-#
-#         logger.info(f"PLC/Stratification will be initiated: {will_forward}")
-#
-#         if will_forward:
-#             if not FORWARD_URL:
-#                 return HTTPException(status_code=500, detail="FORWARD_ENABLED=1 but FORWARD_URL is not set")
-#
-#             async with httpx.AsyncClient(timeout=15) as client:
-#                 resp = await client.get(target_url)
-#
-#             try:
-#                 upstream_body = resp.json()
-#             except Exception:
-#                 upstream_body = resp.text
-#
-#             logger.info(f"/redcap-complete-user forwarded userId={user_id} → {FORWARD_URL} ({resp.status_code})")
-#
-#             return ForwardUserResponse(
-#                 status="forwarded",
-#                 userId=user_id,
-#                 category=category,
-#                 upstream_status_code=resp.status_code,
-#                 upstream_body=upstream_body,
-#             )
-#
-#         # ----------------------------
-#         # 4. Local testing mode
-#         # ----------------------------
-#         logger.info(f"/redcap-complete-user TEST MODE — retrieved for: {outbound}")
-#
-#         return ForwardUserResponse(
-#             status="received",
-#             userId=user_id,
-#         )
-#
-#     except HTTPException:
-#         raise
-#     except Exception as e:
-#         logger.exception("Unexpected error in /redcap-completed-user")
-#         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/randomization-groups/cache", summary="Allocation cache counters")
+async def randomization_cache_stats():
+    return allocation_cache.stats()
+
+
+@app.post("/sync/run", summary="Run an incremental REDCap -> SQL sync now (409 while one is running)")
+async def run_redcap_sync(full: bool = Query(False, description="Ignore the watermark and copy everything")):
+    import sync
+    try:
+        return await asyncio.to_thread(sync.run_sync, full)
+    except sync.SyncInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.exception("Error in /sync/run")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/sync/status", summary="Watermark and counters of the last REDCap -> SQL sync")
+async def redcap_sync_status():
+    import sync
+    return await asyncio.to_thread(sync.sync_status, api_url(REDCAP_API_URL), REDCAP_API_TOKEN)
+
+
+@app.get(
+    "/list-user-ids",
+    summary="Return all userIds in the UserProfile collection"
+)
+async def list_user_ids():
+    store = require_mongo()
+    try:
+        return await store.list_user_ids()
+
+    except Exception as e:
+        logger.exception("Error in /list-user-ids")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/mongo-health", summary="Check MongoDB connectivity (ping + optional deep check)")
+async def mongo_health(deep: bool = Query(True, description="Include DB/collections info")):
+    store = require_mongo()
+    from pymongo.errors import PyMongoError
+    try:
+        # Quick connectivity check (works with auth)
+        latency_ms = await store.ping()
+
+        payload = {
+            "status": "ok",
+            "latency_ms": latency_ms,
+            "db": store.db.name,
+            "max_pool_size": db.MONGODB_MAX_POOL_SIZE,
+        }
+
+        if deep:
+            # "Deep" but still light: list collections in the target DB
+            payload["collections"] = await store.collection_names()
+
+        return FastJSONResponse(status_code=200, content=payload)
+
+    except PyMongoError as e:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "status": "error",
+                "message": "MongoDB ping failed",
+                "error": str(e),
+            },
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "status": "error",
+                "message": "Unexpected error during MongoDB health check",
+                "error": str(e),
+            },
+        )
+
+
+async def handle_completed_user(payload: Dict[str, Any]) -> ForwardUserResponse:
+    """Decide whether a completed instrument triggers PLC/stratification and forward it."""
+    # ----------------------------
+    # 1. Extract userId
+    # ----------------------------
+    user_id = payload.get("record_id")
+    instrument_name = payload.get("instrument")
+
+    if not user_id:
+        logger.error("Missing userId in incoming JSON")
+        raise HTTPException(status_code=400, detail="Missing required field: userId")
+
+    logger.info(f"/redcap-complete-user received payload for userId={user_id}")
+    logger.debug(f"Full payload: {json.dumps(payload, ensure_ascii=False)}")
+
+    SEND_REQUEST = False
+
+    category = await require_mongo().get_category(user_id)
+    if category is None:
+        raise HTTPException(status_code=404, detail=f"No category found for userId={user_id}")
+
+    logger.info(f"The group of user {user_id} is {category}.")
+
+    ###
+    if instrument_name == "functionality_appreciation_scale_fas" and category in ["healthy", "HEALTHY"]:
+        SEND_REQUEST = True
+        logger.info("Will send upstream request.")
+
+    if (instrument_name == "edmonton_symptom_assessment_system_revised_esasr" and
+            category not in ["healthy", "HEALTHY"]):
+        SEND_REQUEST = True
+        logger.info("Will send upstream request.")
+
+    # ----------------------------
+    # 2. Build outbound payload
+    # ----------------------------
+    outbound = {"userId": user_id}
+
+    # ----------------------------
+    # 3. Forward if enabled
+    # ----------------------------
+
+    target_url = f"{FORWARD_URL}/users/{user_id}/status/today"
+
+    will_forward = SEND_REQUEST and FORWARD_ENABLED
+
+    logger.info(f"PLC/Stratification will be initiated: {will_forward}")
+
+    if will_forward:
+        if not FORWARD_URL:
+            raise HTTPException(status_code=500, detail="FORWARD_ENABLED=1 but FORWARD_URL is not set")
+
+        try:
+            resp = await outbound_engine().request("GET", target_url)
+        except CircuitOpenError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        if not resp.is_success:
+            # Retries are exhausted; the status tells the webhook queue whether
+            # to retry the job later (5xx/429) or dead-letter it (4xx)
+            raise HTTPException(status_code=resp.status_code,
+                                detail=f"Forwarding userId={user_id} failed: upstream returned {resp.status_code}")
+
+        try:
+            upstream_body = resp.json()
+        except Exception:
+            upstream_body = resp.text
+
+        logger.info(f"/redcap-complete-user forwarded userId={user_id} → {FORWARD_URL} ({resp.status_code})")
+
+        return ForwardUserResponse(
+            status="forwarded",
+            userId=user_id,
+            category=category,
+            upstream_status_code=resp.status_code,
+            upstream_body=upstream_body,
+        )
+
+    # ----------------------------
+    # 4. Local testing mode
+    # ----------------------------
+    logger.info(f"/redcap-complete-user TEST MODE — retrieved for: {outbound}")
+
+    return ForwardUserResponse(
+        status="received",
+        userId=user_id,
+        category=category,
+    )
+
+
+@app.post(
+    "/redcap-completed-user",
+    response_model=WebhookAck,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Receive a REDCap completion webhook and queue it for category lookup and forwarding"
+)
+async def forward_user_id(
+    payload: Dict[str, Any] = Body(...),
+    username: str = Depends(get_current_username)
+):
+    user_id = payload.get("record_id")
+    if not user_id:
+        logger.error("Missing userId in incoming JSON")
+        raise HTTPException(status_code=400, detail="Missing required field: userId")
+
+    try:
+        job_id, duplicate = await open_webhook_queue().enqueue(payload)
+    except Exception as e:
+        logger.exception("Unexpected error in /redcap-completed-user")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return WebhookAck(status="duplicate" if duplicate else "queued", job_id=job_id, userId=user_id)
+
+
+@app.get("/webhook-queue", summary="Depth of the durable webhook queue by job state")
+async def webhook_queue_depth():
+    return await open_webhook_queue().depth()
+
+
+@app.get("/webhook-queue/dead", summary="Dead-lettered webhook jobs")
+async def webhook_queue_dead(limit: int = Query(100, ge=1, le=1000)):
+    return await open_webhook_queue().dead_letters(limit)
+
+
+@app.post("/webhook-queue/dead/{job_id}/retry", summary="Move a dead-lettered webhook job back to the queue")
+async def webhook_queue_retry(job_id: int):
+    if not await open_webhook_queue().requeue(job_id):
+        raise HTTPException(status_code=404, detail=f"No dead-lettered job {job_id}")
+    return {"status": "requeued", "job_id": job_id}
+
+
+@app.get("/forwarding/stats", summary="Per-target retry, failure and circuit-breaker state of outbound forwarding")
+async def forwarding_stats():
+    return outbound_engine().stats()
+
+
+startup["import_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
 
 
 # Run locally
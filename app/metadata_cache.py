@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from choice_index import ChoiceIndex
+from timing import timed, timed_call
+from singleflight import SingleFlight
+
+
+logger = logging.getLogger("redcap-utils")
+
+METADATA_CACHE_TTL_S = float(os.getenv("METADATA_CACHE_TTL_S", "3600"))
+METADATA_CACHE_MAX_PROJECTS = int(os.getenv("METADATA_CACHE_MAX_PROJECTS", "8"))
+# How far back to look in the REDCap "manage" log when revalidating. REDCap
+# logs in server-local time, so this also absorbs clock/timezone drift.
+METADATA_LOG_SKEW_S = float(os.getenv("METADATA_LOG_SKEW_S", "300"))
+# Field/form selections memoized per dictionary version (LRU); callers pick
+# the selection, so this must stay bounded
+METADATA_SUBSETS_MAX = int(os.getenv("METADATA_SUBSETS_MAX", "32"))
+
+
+class MetadataEntry:
+    """A project's data dictionary plus the lookups derived from it."""
+
+    def __init__(self, metadata: List[Dict[str, Any]]):
+        self.metadata = metadata
+        self.version = hashlib.sha1(
+            json.dumps(metadata, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        self.fields = {m["field_name"]: m for m in metadata}
+        self.field_labels = {m["field_name"]: m["field_label"] for m in metadata}
+        self.loaded_at = datetime.now()
+        self.checked_at = time.monotonic()
+        self._choices: Optional[ChoiceIndex] = None
+        self._subsets: "OrderedDict[Tuple[Tuple[str, ...], Tuple[str, ...]], MetadataSubset]" = OrderedDict()
+        self._subsets_lock = threading.Lock()
+
+    @property
+    def def_field(self) -> str:
+        # REDCap's record id field is always the first field of the dictionary
+        return self.metadata[0]["field_name"]
+
+    @property
+    def choices(self) -> ChoiceIndex:
+        # Built lazily, then reused for as long as this metadata version lives.
+        if self._choices is None:
+            self._choices = ChoiceIndex(self.metadata)
+        return self._choices
+
+    @property
+    def forms(self) -> List[str]:
+        return list(dict.fromkeys(m["form_name"] for m in self.metadata))
+
+    def restrict(self, fields: Optional[List[str]] = None,
+                 forms: Optional[List[str]] = None) -> "MetadataSubset":
+        """
+        The part of the dictionary covered by `fields` and/or whole `forms`
+        (record id field always included), memoized for the most recent
+        METADATA_SUBSETS_MAX selections. Raises ValueError for names that are
+        not in the project.
+        """
+        key = (tuple(sorted(set(fields or ()))), tuple(sorted(set(forms or ()))))
+        with self._subsets_lock:
+            subset = self._subsets.get(key)
+            if subset is not None:
+                self._subsets.move_to_end(key)
+                return subset
+        known_forms = set(self.forms)
+        unknown = [f for f in key[0] if f not in self.fields
+                   and not (f.endswith("_complete") and f[:-len("_complete")] in known_forms)]
+        unknown += [f"form '{f}'" for f in key[1] if f not in known_forms]
+        if unknown:
+            raise ValueError(f"Not in the project's data dictionary: {', '.join(unknown)}")
+        subset = MetadataSubset(self, set(key[0]), set(key[1]))
+        with self._subsets_lock:
+            self._subsets[key] = subset
+            while len(self._subsets) > METADATA_SUBSETS_MAX:
+                self._subsets.popitem(last=False)
+        return subset
+
+
+class MetadataSubset:
+    """Restricted view of a MetadataEntry with the same lookup attributes."""
+
+    def __init__(self, entry: MetadataEntry, fields: set, forms: set):
+        self.version = entry.version
+        self.def_field = entry.def_field
+        self.metadata = [m for m in entry.metadata
+                         if m["field_name"] == self.def_field or m["field_name"] in fields
+                         or m["form_name"] in forms]
+        self.fields = {m["field_name"]: m for m in self.metadata}
+        self.field_labels = {m["field_name"]: m["field_label"] for m in self.metadata}
+
+
+class MetadataCache:
+    """
+    LRU cache of REDCap data dictionaries keyed by (url, token).
+
+    Entries are served from memory for `ttl` seconds. After that, the project's
+    "manage" log is checked for design changes since the entry was loaded; if
+    nothing changed the entry is kept for another TTL window, otherwise (or if
+    the token cannot read logs) the metadata is downloaded again.
+    """
+
+    def __init__(self, ttl: float = METADATA_CACHE_TTL_S,
+                 max_projects: int = METADATA_CACHE_MAX_PROJECTS):
+        self.ttl = ttl
+        self.max_projects = max_projects
+        self._entries: "OrderedDict[Tuple[str, str], MetadataEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._flight = SingleFlight("metadata")
+
+    def _lookup(self, key) -> Optional[MetadataEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _is_fresh(self, entry: MetadataEntry) -> bool:
+        return time.monotonic() - entry.checked_at < self.ttl
+
+    def _revalidate_begin(self, entry: MetadataEntry) -> datetime:
+        return entry.loaded_at - timedelta(seconds=METADATA_LOG_SKEW_S)
+
+    def _revalidate(self, project, entry: MetadataEntry) -> bool:
+        """Return True if the project design has not changed since `entry` was loaded."""
+        try:
+            logs = project.export_logging(format_type="json", log_type="manage",
+                                          begin_time=self._revalidate_begin(entry))
+        except Exception as e:
+            logger.info(f"Metadata revalidation unavailable, reloading: {e}")
+            return False
+        self.revalidations += 1
+        return not logs
+
+    async def _arevalidate(self, client, entry: MetadataEntry) -> bool:
+        try:
+            logs = await client.export_logging(log_type="manage",
+                                               begin_time=self._revalidate_begin(entry))
+        except Exception as e:
+            logger.info(f"Metadata revalidation unavailable, reloading: {e}")
+            return False
+        self.revalidations += 1
+        return not logs
+
+    def store(self, key, metadata: List[Dict[str, Any]]) -> MetadataEntry:
+        entry = MetadataEntry(metadata)
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None and previous.version == entry.version:
+                # Same dictionary re-downloaded; keep the derived lookups.
+                previous.loaded_at = entry.loaded_at
+                previous.checked_at = entry.checked_at
+                entry = previous
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_projects:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _cached(self, key) -> Tuple[Optional[MetadataEntry], bool]:
+        """Return (entry, fresh) for `key`; entry is None on a cold miss."""
+        entry = self._lookup(key)
+        if entry is not None and self._is_fresh(entry):
+            self.hits += 1
+            return entry, True
+        return entry, False
+
+    def _revalidated(self, entry: MetadataEntry) -> MetadataEntry:
+        self.hits += 1
+        entry.checked_at = time.monotonic()
+        return entry
+
+    def _loaded(self, key, metadata: List[Dict[str, Any]]) -> MetadataEntry:
+        self.misses += 1
+        entry = self.store(key, metadata)
+        logger.info(f"Loaded REDCap metadata ({len(metadata)} fields, version {entry.version})")
+        return entry
+
+    def get(self, project) -> MetadataEntry:
+        """Return the cached metadata entry for a PyCap Project, loading it if needed."""
+        key = (project.url, project.token)
+        entry, fresh = self._cached(key)
+        if fresh:
+            return entry
+        if entry is not None and self._revalidate(project, entry):
+            return self._revalidated(entry)
+        with timed("metadata_export"):
+            metadata = project.export_metadata(format_type="json")
+        return self._loaded(key, metadata)
+
+    async def aget(self, client) -> MetadataEntry:
+        """Async counterpart of get() for an AsyncRedcapClient."""
+        key = (client.url, client.token)
+        entry, fresh = self._cached(key)
+        if fresh:
+            return entry
+        # Concurrent misses for one project share a single revalidation/export
+        return await self._flight.do(key, lambda: self._aload(client, key, entry))
+
+    async def _aload(self, client, key, entry: Optional[MetadataEntry]) -> MetadataEntry:
+        if entry is not None and await self._arevalidate(client, entry):
+            return self._revalidated(entry)
+        # Only real downloads are timed, not cache hits or revalidations
+        return self._loaded(key, await timed_call("metadata_export", client.export_metadata()))
+
+    def invalidate(self, url: Optional[str] = None, token: Optional[str] = None) -> int:
+        """Drop one project's entry, or every entry when no key is given."""
+        with self._lock:
+            if url is None:
+                n = len(self._entries)
+                self._entries.clear()
+                return n
+            return 1 if self._entries.pop((url, token), None) is not None else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            versions = [e.version for e in self._entries.values()]
+        return {
+            "projects": len(versions),
+            "versions": versions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "coalesced": self._flight.shared,
+            "ttl_s": self.ttl,
+        }
+
+
+metadata_cache = MetadataCache()
+
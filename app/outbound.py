@@ -0,0 +1,214 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from timing import timed
+
+if TYPE_CHECKING:
+    import httpx
+
+
+logger = logging.getLogger("redcap-utils")
+
+FORWARD_TIMEOUT_S = float(os.getenv("FORWARD_TIMEOUT_S", "15"))
+FORWARD_MAX_CONNECTIONS = int(os.getenv("FORWARD_MAX_CONNECTIONS", "50"))
+FORWARD_MAX_KEEPALIVE = int(os.getenv("FORWARD_MAX_KEEPALIVE", "20"))
+FORWARD_MAX_RETRIES = int(os.getenv("FORWARD_MAX_RETRIES", "4"))
+FORWARD_BACKOFF_BASE_S = float(os.getenv("FORWARD_BACKOFF_BASE_S", "0.5"))
+FORWARD_BACKOFF_MAX_S = float(os.getenv("FORWARD_BACKOFF_MAX_S", "10"))
+FORWARD_CONCURRENCY_PER_TARGET = int(os.getenv("FORWARD_CONCURRENCY_PER_TARGET", "8"))
+FORWARD_BREAKER_THRESHOLD = int(os.getenv("FORWARD_BREAKER_THRESHOLD", "5"))
+FORWARD_BREAKER_RESET_S = float(os.getenv("FORWARD_BREAKER_RESET_S", "30"))
+
+
+def _retryable(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+class CircuitOpenError(Exception):
+    """The target has failed repeatedly; calls are rejected until the breaker resets."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker: opens after `threshold` failed requests (a
+    request fails once, after its last retry), lets a single probe through
+    after `reset_after` seconds, and closes again on success.
+    """
+
+    def __init__(self, threshold: int = FORWARD_BREAKER_THRESHOLD, reset_after: float = FORWARD_BREAKER_RESET_S):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> Tuple[bool, bool]:
+        """(allowed, probe): `probe` is True when this call claimed the half-open probe."""
+        state = self.state
+        if state == "closed":
+            return True, False
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True, True
+        return False, False
+
+    def release_probe(self):
+        """End a probe that produced no outcome (cancelled, unexpected error), so another may run."""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class _Target:
+    __slots__ = ("semaphore", "breaker", "sent", "retries", "failures", "rejected")
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker()
+        self.sent = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    # Full jitter, but never earlier than an explicit Retry-After
+    delay = random.uniform(0, min(FORWARD_BACKOFF_MAX_S, FORWARD_BACKOFF_BASE_S * 2 ** attempt))
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), FORWARD_BACKOFF_MAX_S))
+    return delay
+
+
+class DeliveryEngine:
+    """
+    Outbound HTTP over one shared keep-alive AsyncClient with retries
+    (exponential backoff + jitter), a concurrency cap and a circuit breaker
+    per target host.
+    """
+
+    def __init__(self, client: "httpx.AsyncClient", max_retries: int = FORWARD_MAX_RETRIES,
+                 concurrency_per_target: int = FORWARD_CONCURRENCY_PER_TARGET):
+        self.client = client
+        self.max_retries = max_retries
+        self.concurrency_per_target = concurrency_per_target
+        self._targets: Dict[str, _Target] = {}
+
+    def _target(self, url: str) -> _Target:
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}"
+        target = self._targets.get(key)
+        if target is None:
+            target = self._targets[key] = _Target(self.concurrency_per_target)
+        return target
+
+    async def request(self, method: str, url: str, **kwargs) -> "httpx.Response":
+        """
+        Send a request, retrying transport errors, 429 and 5xx. Returns
+        the last response (which may still be an error status) or raises the
+        last transport error / CircuitOpenError. The breaker sees one outcome
+        per request, not one per attempt.
+        """
+        target = self._target(url)
+        breaker = target.breaker
+        allowed, probe = breaker.allow()
+        if not allowed:
+            target.rejected += 1
+            raise CircuitOpenError(f"circuit open for {url}")
+        try:
+            return await self._send(target, method, url, **kwargs)
+        finally:
+            if probe:
+                breaker.release_probe()
+
+    async def _send(self, target: _Target, method: str, url: str, **kwargs) -> "httpx.Response":
+        import httpx  # already loaded by open_engine()
+        attempt = 0
+        while True:
+            retry_after = None
+            async with target.semaphore:
+                target.sent += 1
+                try:
+                    with timed("outbound_forward"):
+                        resp = await self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    resp, error = None, e
+                else:
+                    error = None
+
+            if resp is not None and not _retryable(resp.status_code):
+                target.breaker.record_success()
+                return resp
+
+            if attempt >= self.max_retries:
+                target.breaker.record_failure()
+                target.failures += 1
+                if error is not None:
+                    raise error
+                return resp
+
+            if resp is not None:
+                retry_after = resp.headers.get("Retry-After")
+            delay = _backoff(attempt, retry_after)
+            logger.warning(f"{method} {url} failed ({error!r} / {resp.status_code if resp is not None else '-'}), "
+                           f"retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+            target.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            key: {
+                "state": t.breaker.state,
+                "sent": t.sent,
+                "retries": t.retries,
+                "failures": t.failures,
+                "rejected": t.rejected,
+            }
+            for key, t in self._targets.items()
+        }
+
+
+engine: Optional[DeliveryEngine] = None
+
+
+def open_engine() -> DeliveryEngine:
+    """The shared forwarding client, created on first use (closed from the app lifespan)."""
+    global engine
+    if engine is None:
+        import httpx
+        client = httpx.AsyncClient(
+            timeout=FORWARD_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=FORWARD_MAX_CONNECTIONS,
+                                max_keepalive_connections=FORWARD_MAX_KEEPALIVE),
+        )
+        engine = DeliveryEngine(client)
+    return engine
+
+
+async def close_engine():
+    global engine
+    if engine is not None:
+        await engine.client.aclose()
+        engine = None
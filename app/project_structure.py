@@ -0,0 +1,129 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from choice_index import normalize_label
+from metadata_cache import metadata_cache
+from singleflight import SingleFlight
+
+
+logger = logging.getLogger("redcap-utils")
+
+PROJECT_STRUCTURE_TTL_S = float(os.getenv("PROJECT_STRUCTURE_TTL_S", "3600"))
+
+
+class ProjectStructure:
+    """
+    Snapshot of the parts of a project that enrolment needs: record id field,
+    DAGs (indexed by unique name, display name and normalized name) and events.
+    Field choices come from the metadata cache.
+    """
+
+    def __init__(self, def_field: str, dags: List[Dict[str, Any]], events: List[Dict[str, Any]]):
+        self.def_field = def_field
+        self.dags = dags
+        self.events = events
+        self.loaded_at = time.monotonic()
+
+        self.dag_by_unique: Dict[str, str] = {}
+        self.dag_by_name: Dict[str, str] = {}
+        self.dag_by_norm: Dict[str, str] = {}
+        for dag in dags:
+            unique = dag.get("unique_group_name", "")
+            name = dag.get("data_access_group_name", "")
+            self.dag_by_unique.setdefault(unique.lower(), unique)
+            self.dag_by_name.setdefault(name.lower(), unique)
+            self.dag_by_norm.setdefault(normalize_label(name), unique)
+
+    @property
+    def is_longitudinal(self) -> bool:
+        return bool(self.events)
+
+    @property
+    def first_event(self) -> Optional[str]:
+        return self.events[0]["unique_event_name"] if self.events else None
+
+    def resolve_dag(self, site: str) -> Optional[str]:
+        """Unique DAG name for a site, matched by unique name, display name, then loosely."""
+        s = site.lower()
+        return self.dag_by_unique.get(s) or self.dag_by_name.get(s) or self.dag_by_norm.get(normalize_label(site))
+
+
+def _is_longitudinal(project_info: Dict[str, Any]) -> bool:
+    return str(project_info.get("is_longitudinal", "0")).lower() in ("1", "true")
+
+
+class StructureCache:
+    def __init__(self, ttl: float = PROJECT_STRUCTURE_TTL_S):
+        self.ttl = ttl
+        self._entries: Dict[Tuple[str, str], ProjectStructure] = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight("structure")
+
+    def _fresh(self, key) -> Optional[ProjectStructure]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl:
+            return entry
+        return None
+
+    def _store(self, key, structure: ProjectStructure) -> ProjectStructure:
+        with self._lock:
+            self._entries[key] = structure
+        logger.info(f"Loaded REDCap project structure ({len(structure.dags)} DAGs, "
+                    f"{len(structure.events)} events)")
+        return structure
+
+    def get(self, project) -> ProjectStructure:
+        """Structure for a PyCap Project, refreshed every `ttl` seconds."""
+        key = (project.url, project.token)
+        entry = self._fresh(key)
+        if entry is not None:
+            return entry
+        def_field = metadata_cache.get(project).def_field
+        dags = project.export_dags()
+        # Classic projects answer exportEvents with an error, so ask first;
+        # any other failure must not be cached as "no events"
+        events = project.export_events() if _is_longitudinal(project.export_project_info()) else []
+        return self._store(key, ProjectStructure(def_field, dags, events))
+
+    async def aget(self, client) -> ProjectStructure:
+        """Async counterpart of get() for an AsyncRedcapClient."""
+        key = (client.url, client.token)
+        entry = self._fresh(key)
+        if entry is not None:
+            return entry
+        return await self._flight.do(key, lambda: self._aload(client, key))
+
+    async def _aload(self, client, key) -> ProjectStructure:
+        meta, dags, info, events = await asyncio.gather(
+            metadata_cache.aget(client),
+            client.export_dags(),
+            client.export_project_info(),
+            client.export_events(),
+            return_exceptions=True,
+        )
+        for result in (meta, dags, info):
+            if isinstance(result, BaseException):
+                raise result
+        # The events export fails by design on classic projects; only then is
+        # its error expected
+        if not _is_longitudinal(info):
+            events = []
+        elif isinstance(events, BaseException):
+            raise events
+        return self._store(key, ProjectStructure(meta.def_field, dags, events))
+
+    def invalidate(self, url: Optional[str] = None, token: Optional[str] = None) -> int:
+        """Drop one project's snapshot, or every snapshot when no project is given."""
+        with self._lock:
+            if url is None:
+                n = len(self._entries)
+                self._entries.clear()
+                return n
+            return 1 if self._entries.pop((url, token), None) is not None else 0
+
+
+structure_cache = StructureCache()
@@ -0,0 +1,283 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import serialization
+from compression import compress
+from singleflight import SingleFlight
+
+
+logger = logging.getLogger("redcap-utils")
+
+RECORD_CACHE_TTL_S = float(os.getenv("RECORD_CACHE_TTL_S", "300"))
+# After the TTL an entry is still served for this long while a background
+# refresh runs (stale-while-revalidate).
+RECORD_CACHE_STALE_S = float(os.getenv("RECORD_CACHE_STALE_S", "3600"))
+RECORD_CACHE_MAX_ENTRIES = int(os.getenv("RECORD_CACHE_MAX_ENTRIES", "1000"))
+# Persist entries in the sync database (SYNC_DB_URL) so they survive restarts
+RECORD_CACHE_PERSIST = os.getenv("RECORD_CACHE_PERSIST", "0") == "1"
+
+HIT, MISS, STALE = "HIT", "MISS", "STALE"
+
+
+def project_prefix(url: str, token: str) -> str:
+    """Prefix shared by every cache_key() of one project."""
+    return hashlib.sha256(f"{url}|{token}".encode("utf-8")).hexdigest()[:16] + ":"
+
+
+def cache_key(url: str, token: str, record_id: str, projection: str = "") -> str:
+    """`projection` (fields/forms/events) is appended after '?', so invalidating a record drops all its variants."""
+    key = f"{project_prefix(url, token)}{record_id}"
+    return f"{key}?{projection}" if projection else key
+
+
+def body_etag(body: bytes) -> str:
+    """Weak ETag over an encoded body (weak: the body may be re-encoded or compressed)."""
+    return f'W/"{hashlib.sha1(body).hexdigest()[:24]}"'
+
+
+class CacheEntry:
+    """
+    A cached value plus, built on first use and kept with it, its encoded
+    representations (JSON / NDJSON, optionally gzip/zstd-compressed) and ETag,
+    so repeated hits are served without re-encoding.
+    """
+
+    __slots__ = ("value", "stored_at", "_etag", "_encoded")
+
+    def __init__(self, value: Any, stored_at: Optional[float] = None, body: Optional[bytes] = None):
+        self.value = value
+        self.stored_at = stored_at if stored_at is not None else time.time()
+        self._etag: Optional[str] = None
+        self._encoded: Optional[Dict[Tuple[str, Optional[str]], bytes]] = {("json", None): body} if body else None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+    @property
+    def etag(self) -> str:
+        # Hashed once per stored value, not per request
+        if self._etag is None:
+            self._etag = body_etag(self.encoded())
+        return self._etag
+
+    def encoded(self, variant: str = "json", coding: Optional[str] = None) -> bytes:
+        """The value as "json" or "ndjson" bytes, compressed with `coding` ("gzip"/"zstd") if given."""
+        if self._encoded is None:
+            self._encoded = {}
+        data = self._encoded.get((variant, coding))
+        if data is None:
+            if coding is not None:
+                data = compress(self.encoded(variant), coding)
+            elif variant == "ndjson":
+                data = serialization.ndjson(self.value)
+            else:
+                data = serialization.dumps(self.value)
+            self._encoded[(variant, coding)] = data
+        return data
+
+
+class SqlRecordStore:
+    """Persistent second level for RecordCache, stored next to the synced records."""
+
+    def __init__(self, engine=None):
+        from sqlalchemy import Column, Float, MetaData, String, Table, Text
+
+        import sync
+
+        self.engine = engine or sync.get_engine()
+        md = MetaData()
+        self.table = Table(
+            "redcap_record_cache", md,
+            Column("key", String(200), primary_key=True),
+            Column("payload", Text, nullable=False),
+            Column("stored_at", Float, nullable=False),
+        )
+        md.create_all(self.engine)
+
+    def _get(self, key: str) -> Optional[CacheEntry]:
+        from sqlalchemy import select
+
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(self.table.c.payload, self.table.c.stored_at).where(self.table.c.key == key)
+            ).first()
+        if row is None:
+            return None
+        # The stored text is already the JSON body; keep it instead of re-encoding
+        body = row.payload.encode("utf-8")
+        return CacheEntry(serialization.loads(body), row.stored_at, body=body)
+
+    def _set(self, key: str, entry: CacheEntry) -> None:
+        payload = entry.encoded().decode("utf-8")
+        with self.engine.begin() as conn:
+            res = conn.execute(self.table.update().where(self.table.c.key == key)
+                               .values(payload=payload, stored_at=entry.stored_at))
+            if not res.rowcount:
+                conn.execute(self.table.insert().values(key=key, payload=payload, stored_at=entry.stored_at))
+
+    def _delete(self, key: Optional[str]) -> None:
+        with self.engine.begin() as conn:
+            stmt = self.table.delete()
+            if key is not None:
+                stmt = stmt.where((self.table.c.key == key) | self.table.c.key.startswith(f"{key}?", autoescape=True))
+            conn.execute(stmt)
+
+    def _delete_prefix(self, prefix: str) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.key.startswith(prefix, autoescape=True)))
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, entry: CacheEntry) -> None:
+        await asyncio.to_thread(self._set, key, entry)
+
+    async def delete(self, key: Optional[str] = None) -> None:
+        await asyncio.to_thread(self._delete, key)
+
+    async def delete_prefix(self, prefix: str) -> None:
+        await asyncio.to_thread(self._delete_prefix, prefix)
+
+
+class RecordCache:
+    """
+    Read-through, size-bounded LRU cache of per-record exports with
+    stale-while-revalidate and an optional persistent second level.
+    """
+
+    def __init__(self, ttl: float = RECORD_CACHE_TTL_S, stale: float = RECORD_CACHE_STALE_S,
+                 max_entries: int = RECORD_CACHE_MAX_ENTRIES, store: Optional[SqlRecordStore] = None):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self.store = store
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # Concurrent loads of one key (misses, refresh=true, background
+        # refreshes) share a single upstream fetch
+        self._flight = SingleFlight("record")
+        self.counts = {HIT: 0, MISS: 0, STALE: 0}
+
+    def _remember(self, key: str, entry: CacheEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _lookup(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self.store is not None:
+            try:
+                entry = await self.store.get(key)
+            except Exception as e:
+                logger.warning(f"Record cache store read failed: {e}")
+                return None
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    async def set(self, key: str, value: Any) -> CacheEntry:
+        entry = CacheEntry(value)
+        self._remember(key, entry)
+        if self.store is not None:
+            try:
+                await self.store.set(key, entry)
+            except Exception as e:
+                logger.warning(f"Record cache store write failed: {e}")
+        return entry
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> CacheEntry:
+        return await self._flight.do(key, lambda: self._fetch_and_set(key, loader))
+
+    async def _fetch_and_set(self, key: str, loader: Callable[[], Awaitable[Any]]) -> CacheEntry:
+        return await self.set(key, await loader())
+
+    def _refresh_in_background(self, key: str, loader: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._load(key, loader)
+            except Exception as e:
+                logger.warning(f"Background refresh of {key} failed: {e}")
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.create_task(refresh())
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]],
+                          refresh: bool = False, load: bool = True) -> Tuple[Optional[CacheEntry], str]:
+        """
+        Return (entry, HIT/STALE/MISS); the entry carries the value, its age and
+        ETag. With load=False a miss returns (None, MISS) and nothing is
+        fetched, for callers that stream the export themselves.
+        """
+        entry = None if refresh else await self._lookup(key)
+        if entry is not None:
+            age = entry.age
+            if age < self.ttl:
+                self.counts[HIT] += 1
+                return entry, HIT
+            if age < self.ttl + self.stale:
+                self.counts[STALE] += 1
+                self._refresh_in_background(key, loader)
+                return entry, STALE
+
+        self.counts[MISS] += 1
+        if not load:
+            return None, MISS
+        return await self._load(key, loader), MISS
+
+    async def invalidate(self, key: Optional[str] = None) -> None:
+        if key is None:
+            self._entries.clear()
+        else:
+            variants = [k for k in self._entries if k == key or k.startswith(f"{key}?")]
+            for k in variants:
+                del self._entries[k]
+        if self.store is not None:
+            await self.store.delete(key)
+
+    async def invalidate_project(self, url: str, token: str) -> int:
+        """Drop every record (all variants) cached for one project; returns the in-memory count."""
+        prefix = project_prefix(url, token)
+        keys = [k for k in self._entries if k.startswith(prefix)]
+        for k in keys:
+            del self._entries[k]
+        if self.store is not None:
+            await self.store.delete_prefix(prefix)
+        return len(keys)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "refreshing": len(self._refreshing),
+            "hits": self.counts[HIT],
+            "stale_hits": self.counts[STALE],
+            "misses": self.counts[MISS],
+            "coalesced": self._flight.shared,
+            "ttl_s": self.ttl,
+            "stale_s": self.stale,
+            "persistent": self.store is not None,
+        }
+
+
+record_cache = RecordCache()
+
+
+def open_record_cache() -> RecordCache:
+    """Attach the persistent store when RECORD_CACHE_PERSIST=1 (called from the app lifespan)."""
+    if RECORD_CACHE_PERSIST and record_cache.store is None:
+        record_cache.store = SqlRecordStore()
+        logger.info("Record cache persistence enabled")
+    return record_cache
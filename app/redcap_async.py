@@ -0,0 +1,196 @@
+import os
+import json
+import logging
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from timing import timed
+
+if TYPE_CHECKING:
+    import httpx
+
+
+logger = logging.getLogger("redcap-utils")
+
+REDCAP_MAX_CONNECTIONS = int(os.getenv("REDCAP_MAX_CONNECTIONS", "20"))
+REDCAP_MAX_KEEPALIVE = int(os.getenv("REDCAP_MAX_KEEPALIVE", "10"))
+REDCAP_CONNECT_TIMEOUT_S = float(os.getenv("REDCAP_CONNECT_TIMEOUT_S", "5"))
+REDCAP_READ_TIMEOUT_S = float(os.getenv("REDCAP_READ_TIMEOUT_S", "30"))
+
+
+class RedcapApiError(Exception):
+    """REDCap answered with an error payload or a non-2xx status."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _add_array(payload: Dict[str, Any], key: str, values) -> None:
+    # REDCap expects PHP-style arrays: fields[0]=a&fields[1]=b
+    if values is None:
+        return
+    if isinstance(values, str):
+        values = [values]
+    for i, v in enumerate(values):
+        payload[f"{key}[{i}]"] = v
+
+
+def _fmt_time(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class AsyncRedcapClient:
+    """
+    Minimal asyncio REDCap API client over a shared httpx.AsyncClient.
+
+    Method names and keyword arguments mirror PyCap's Project so call sites
+    read the same; only JSON is supported.
+    """
+
+    def __init__(self, url: str, token: str, http: "httpx.AsyncClient"):
+        self._url = url
+        self._token = token
+        self._http = http
+        self._connected = False
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @property
+    def token(self) -> str:
+        return self._token
+
+    async def _call(self, payload: Dict[str, Any]) -> Any:
+        import httpx  # already loaded by open_http(); just a sys.modules lookup
+        data = {"token": self._token, "format": "json", "returnFormat": "json", **payload}
+        try:
+            if self._connected:
+                resp = await self._http.post(self._url, data=data)
+            else:
+                # The first round-trip pays DNS + TCP + TLS; that is the "connect" cost
+                with timed("project_connect"):
+                    resp = await self._http.post(self._url, data=data)
+                self._connected = True
+        except httpx.HTTPError as e:
+            raise RedcapApiError(f"REDCap request failed: {e!r}") from e
+
+        try:
+            content = resp.json()
+        except ValueError:
+            content = resp.text
+
+        if resp.status_code >= 400 or (isinstance(content, dict) and "error" in content):
+            msg = content.get("error") if isinstance(content, dict) else content
+            raise RedcapApiError(f"REDCap error ({resp.status_code}): {msg}", resp.status_code)
+        return content
+
+    async def export_metadata(self, fields: Optional[List[str]] = None,
+                              forms: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        payload = {"content": "metadata"}
+        _add_array(payload, "fields", fields)
+        _add_array(payload, "forms", forms)
+        return await self._call(payload)
+
+    async def export_records(
+        self,
+        records: Optional[List[str]] = None,
+        fields: Optional[List[str]] = None,
+        forms: Optional[List[str]] = None,
+        events: Optional[List[str]] = None,
+        raw_or_label: str = "raw",
+        raw_or_label_headers: str = "raw",
+        export_data_access_groups: bool = False,
+        filter_logic: Optional[str] = None,
+        date_begin: Optional[datetime] = None,
+        date_end: Optional[datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        payload = {
+            "content": "record",
+            "type": "flat",
+            "rawOrLabel": raw_or_label,
+            "rawOrLabelHeaders": raw_or_label_headers,
+            "exportDataAccessGroups": "true" if export_data_access_groups else "false",
+        }
+        _add_array(payload, "records", records)
+        _add_array(payload, "fields", fields)
+        _add_array(payload, "forms", forms)
+        _add_array(payload, "events", events)
+        if filter_logic:
+            payload["filterLogic"] = filter_logic
+        if date_begin:
+            payload["dateRangeBegin"] = _fmt_time(date_begin)
+        if date_end:
+            payload["dateRangeEnd"] = _fmt_time(date_end)
+        return await self._call(payload)
+
+    async def export_dags(self) -> List[Dict[str, Any]]:
+        return await self._call({"content": "dag"})
+
+    async def export_events(self) -> List[Dict[str, Any]]:
+        return await self._call({"content": "event"})
+
+    async def export_project_info(self) -> Dict[str, Any]:
+        return await self._call({"content": "project"})
+
+    async def export_logging(self, log_type: Optional[str] = None,
+                             begin_time: Optional[datetime] = None,
+                             end_time: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        payload = {"content": "log"}
+        if log_type:
+            payload["logtype"] = log_type
+        if begin_time:
+            payload["beginTime"] = _fmt_time(begin_time)
+        if end_time:
+            payload["endTime"] = _fmt_time(end_time)
+        return await self._call(payload)
+
+    async def import_records(self, to_import: List[Dict[str, Any]], overwrite: str = "normal",
+                             return_content: str = "count", date_format: str = "YMD"):
+        payload = {
+            "content": "record",
+            "type": "flat",
+            "overwriteBehavior": overwrite,
+            "returnContent": return_content,
+            "dateFormat": date_format,
+            "data": json.dumps(to_import),
+        }
+        return await self._call(payload)
+
+
+_http: Optional["httpx.AsyncClient"] = None
+_clients: Dict[Tuple[str, str], AsyncRedcapClient] = {}
+
+
+def open_http(max_connections: int = REDCAP_MAX_CONNECTIONS,
+              max_keepalive: int = REDCAP_MAX_KEEPALIVE) -> "httpx.AsyncClient":
+    """Create the shared REDCap AsyncClient (called from the app lifespan)."""
+    global _http
+    if _http is None:
+        import httpx
+        _http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(REDCAP_READ_TIMEOUT_S, connect=REDCAP_CONNECT_TIMEOUT_S),
+        )
+        logger.info(f"REDCap async client opened (max_connections={max_connections})")
+    return _http
+
+
+async def close_http():
+    global _http
+    _clients.clear()
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+        logger.info("REDCap async client closed")
+
+
+def get_redcap_client(url: str, token: str) -> AsyncRedcapClient:
+    key = (url, token)
+    client = _clients.get(key)
+    if client is None:
+        client = AsyncRedcapClient(url, token, open_http())
+        _clients[key] = client
+    return client
@@ -0,0 +1,90 @@
+import os
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Tuple
+
+
+if TYPE_CHECKING:
+    from redcap import Project
+
+
+logger = logging.getLogger("redcap-utils")
+
+REDCAP_POOL_CONNECTIONS = int(os.getenv("REDCAP_POOL_CONNECTIONS", "4"))
+REDCAP_POOL_MAXSIZE = int(os.getenv("REDCAP_POOL_MAXSIZE", "20"))
+REDCAP_TIMEOUT_S = float(os.getenv("REDCAP_TIMEOUT_S", "30"))
+
+
+class ProjectRegistry:
+    """
+    Process-wide cache of PyCap Project objects keyed by (url, token).
+
+    PyCap memoizes def_field, metadata and is_longitudinal on the Project
+    instance, so reusing one instance per project means those bootstrap calls
+    are paid once per process instead of once per request. All projects share
+    PyCap's module-level requests.Session, which we mount with a sized
+    keep-alive connection pool. PyCap (and requests) are imported on first
+    use, so processes that only use the async client never load them.
+    """
+
+    def __init__(self, pool_connections: int = REDCAP_POOL_CONNECTIONS,
+                 pool_maxsize: int = REDCAP_POOL_MAXSIZE,
+                 timeout: float = REDCAP_TIMEOUT_S):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._projects: Dict[Tuple[str, str], "Project"] = {}
+        self._lock = threading.Lock()
+        self._opened = False
+
+    @property
+    def session(self):
+        import redcap.request
+        return redcap.request._session
+
+    def open(self):
+        """Mount the pooled adapter on the shared session (idempotent)."""
+        with self._lock:
+            if self._opened:
+                return
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                  pool_maxsize=self.pool_maxsize)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self._opened = True
+        logger.info(f"REDCap project registry opened (pool_maxsize={self.pool_maxsize})")
+
+    def get(self, url: str, token: str) -> "Project":
+        """Return the shared Project for (url, token), creating it on first use."""
+        key = (url, token)
+        proj = self._projects.get(key)
+        if proj is not None:
+            return proj
+        if not self._opened:
+            self.open()
+        with self._lock:
+            proj = self._projects.get(key)
+            if proj is None:
+                from redcap import Project
+                proj = Project(url, token, timeout=self.timeout)
+                self._projects[key] = proj
+        return proj
+
+    def refresh(self, url: str, token: str) -> "Project":
+        """Drop the cached Project (and its memoized metadata) and build a new one."""
+        with self._lock:
+            self._projects.pop((url, token), None)
+        return self.get(url, token)
+
+    def close(self):
+        """Forget all projects and close pooled connections."""
+        with self._lock:
+            self._projects.clear()
+            if self._opened:
+                self.session.close()
+                self._opened = False
+        logger.info("REDCap project registry closed")
+
+
+registry = ProjectRegistry()
@@ -0,0 +1,53 @@
+"""
+JSON encoding for responses and cached payloads: orjson when installed
+(several times faster than stdlib json on the labelled-record lists), with
+the stdlib as a fallback. Both produce compact UTF-8 and render datetimes as
+ISO 8601; anything else orjson cannot encode natively (ObjectId, Decimal)
+falls back to str(), like the `default=str` used elsewhere.
+"""
+import json
+from typing import Any, Iterable
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return str(obj)
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+    loads = json.loads
+
+
+def ndjson(objs: Iterable[Any]) -> bytes:
+    """One JSON document per line, newline-terminated."""
+    return b"".join(dumps(obj) + b"\n" for obj in objs)
+
+
+class FastJSONResponse(Response):
+    """JSONResponse that encodes with `dumps`; also the app's default response class."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
@@ -0,0 +1,244 @@
+"""
+Lightweight in-process instrumentation: per-stage latency histograms,
+counters and per-route request timings, rendered as JSON (/timings) or in
+the Prometheus text exposition format (/metrics). Numbers are per worker.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Awaitable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+
+logger = logging.getLogger("redcap-utils")
+
+T = TypeVar("T")
+
+# Histogram bucket upper bounds (seconds); +Inf is implicit
+LATENCY_BUCKETS_S = tuple(float(b) for b in os.getenv(
+    "TIMING_BUCKETS_S", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(","))
+# Recent request durations kept per route for percentiles
+TIMING_WINDOW = int(os.getenv("TIMING_WINDOW", "2048"))
+
+
+class Histogram:
+    __slots__ = ("buckets", "count", "total_s", "max_s", "last_s")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_S) + 1)
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.last_s = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_S, seconds)] += 1
+        self.count += 1
+        self.total_s += seconds
+        self.last_s = seconds
+        if seconds > self.max_s:
+            self.max_s = seconds
+
+
+class StageStats(Histogram):
+    __slots__ = ("errors",)
+
+    def __init__(self):
+        super().__init__()
+        self.errors = 0
+
+
+class RouteStats(Histogram):
+    __slots__ = ("statuses", "recent")
+
+    def __init__(self):
+        super().__init__()
+        self.statuses: Dict[int, int] = {}
+        self.recent: Deque[float] = deque(maxlen=TIMING_WINDOW)
+
+    def observe_request(self, status: int, seconds: float):
+        self.observe(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.recent.append(seconds)
+
+
+_stats: Dict[str, StageStats] = {}
+_routes: Dict[Tuple[str, str], RouteStats] = {}
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_lock = threading.Lock()
+
+
+def record(stage: str, seconds: float, error: bool = False) -> None:
+    with _lock:
+        st = _stats.get(stage)
+        if st is None:
+            st = _stats[stage] = StageStats()
+        st.observe(seconds)
+        if error:
+            st.errors += 1
+    logger.debug(f"stage {stage} took {seconds * 1000:.1f} ms")
+
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record(stage, time.perf_counter() - t0, error=True)
+        raise
+    record(stage, time.perf_counter() - t0)
+
+
+async def timed_call(stage: str, awaitable: Awaitable[T]) -> T:
+    """Await `awaitable`, recording its wall time under `stage`."""
+    with timed(stage):
+        return await awaitable
+
+
+def incr(name: str, value: float = 1, **labels: str) -> None:
+    """Increment a counter, e.g. incr("record_cache_requests", result="HIT")."""
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def record_request(method: str, route: str, status: int, seconds: float) -> None:
+    with _lock:
+        rs = _routes.get((method, route))
+        if rs is None:
+            rs = _routes[(method, route)] = RouteStats()
+        rs.observe_request(status, seconds)
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def snapshot() -> Dict[str, dict]:
+    with _lock:
+        return {
+            stage: {
+                "count": st.count,
+                "errors": st.errors,
+                "avg_ms": round(st.total_s / st.count * 1000, 2) if st.count else 0.0,
+                "max_ms": round(st.max_s * 1000, 2),
+                "last_ms": round(st.last_s * 1000, 2),
+            }
+            for stage, st in _stats.items()
+        }
+
+
+def route_snapshot() -> Dict[str, dict]:
+    """Per-route request counts and p50/p95/p99 over the last TIMING_WINDOW requests."""
+    with _lock:
+        routes = [(key, rs.count, dict(rs.statuses), sorted(rs.recent)) for key, rs in _routes.items()]
+    result = {}
+    for (method, route), count, statuses, recent in routes:
+        result[f"{method} {route}"] = {
+            "count": count,
+            "statuses": statuses,
+            "p50_ms": round(_percentile(recent, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(recent, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(recent, 0.99) * 1000, 2),
+            "max_ms": round(recent[-1] * 1000, 2) if recent else 0.0,
+        }
+    return result
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+
+
+def _histogram_lines(name: str, labels: str, h: Histogram) -> List[str]:
+    sep = "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, n in zip(LATENCY_BUCKETS_S, h.buckets):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {h.count}')
+    lines.append(f"{name}_sum{{{labels}}} {h.total_s:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {h.count}")
+    return lines
+
+
+def render_prometheus() -> str:
+    """All stages, routes and counters in the Prometheus text format (0.0.4)."""
+    lines = []
+    with _lock:
+        lines.append("# HELP redcap_utils_stage_seconds Latency of internal stages (REDCap, Mongo, forwards, ...)")
+        lines.append("# TYPE redcap_utils_stage_seconds histogram")
+        for stage, st in sorted(_stats.items()):
+            lines.extend(_histogram_lines("redcap_utils_stage_seconds", _labels([("stage", stage)]), st))
+
+        lines.append("# HELP redcap_utils_stage_errors_total Stages that raised")
+        lines.append("# TYPE redcap_utils_stage_errors_total counter")
+        for stage, st in sorted(_stats.items()):
+            lines.append(f"redcap_utils_stage_errors_total{{{_labels([('stage', stage)])}}} {st.errors}")
+
+        lines.append("# HELP redcap_utils_http_request_seconds HTTP request latency by route")
+        lines.append("# TYPE redcap_utils_http_request_seconds histogram")
+        for (method, route), rs in sorted(_routes.items()):
+            lines.extend(_histogram_lines("redcap_utils_http_request_seconds",
+                                          _labels([("method", method), ("route", route)]), rs))
+
+        lines.append("# HELP redcap_utils_http_requests_total HTTP requests by route and status")
+        lines.append("# TYPE redcap_utils_http_requests_total counter")
+        for (method, route), rs in sorted(_routes.items()):
+            for code, n in sorted(rs.statuses.items()):
+                labels = _labels([("method", method), ("route", route), ("status", str(code))])
+                lines.append(f"redcap_utils_http_requests_total{{{labels}}} {n}")
+
+        by_name: Dict[str, list] = {}
+        for (name, pairs), value in _counters.items():
+            by_name.setdefault(name, []).append((pairs, value))
+    for name, series in sorted(by_name.items()):
+        lines.append(f"# TYPE redcap_utils_{name}_total counter")
+        for pairs, value in sorted(series):
+            lines.append(f"redcap_utils_{name}_total{{{_labels(pairs)}}} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware recording every HTTP request under its route template
+    (e.g. /webhook-queue/dead/{job_id}/retry), timed until the last body chunk
+    is sent so streaming responses are measured in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        t0 = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            status = 500
+            raise
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "<unmatched>"
+            record_request(scope["method"], route, status or 500, time.perf_counter() - t0)
@@ -1,85 +1,65 @@
 import os
 import re
-from redcap import Project
+import asyncio
+import logging
+from b4u_utils import api_url, chunked, resolve_record_ids, REDCAP_EXPORT_CHUNK_SIZE, REDCAP_EXPORT_CONCURRENCY
+from allocation_cache import allocation_cache
+from redcap_registry import registry
+from metadata_cache import metadata_cache
+from choice_index import ChoiceIndex
+from project_structure import ProjectStructure, structure_cache
 
-from datetime import datetime, timezone
-from typing import Optional, Tuple
+from datetime import date, datetime, timezone
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
 
+if TYPE_CHECKING:
+    from redcap import Project
+
+
+logger = logging.getLogger("redcap-utils")
 
 BASE_URL = os.getenv("BASE_URL")
 API_TOKEN = os.getenv("API_TOKEN")
 HEALTH_FIELD = os.getenv("HEALTH_FIELD")
 ALLOC_FIELD = os.getenv("ALLOC_FIELD")
+ENROL_BATCH_SIZE = int(os.getenv("ENROL_BATCH_SIZE", "50"))
+ENROL_CONCURRENCY = int(os.getenv("ENROL_CONCURRENCY", "4"))
 
 
-def api_url(base):
-    base = base.rstrip("/") + "/"
-    return base if base.endswith("api/") else base + "api/"
+# ES, EL, LT, SW
+PREFIX_TO_SITE = {"EL": "greece", "LT": "lithuania", "ES": "spain", "SE": "sweden", "TEST": "greece"}
 
 
-def _resolve_dag_unique(proj, country_code: str) -> str:
-    # import re
-    # m = re.match(r"^[A-Za-z]+", user_id)
-    # if not m:
-        # raise ValueError("user_id must start with a country prefix like EL, LT, ES, SE")
-    # prefix = m.group(0).upper()
-
-    # prefix_to_site = {"EL": "greece", "LT": "lithuania", "ES": "spain", "SE": "sweden"}
-    prefix_to_site = {"EL": "greece", "LT": "lithuania", "ES": "spain", "SE": "sweden", "TEST": "greece"}
-    # ES, EL, LT, SW
-    site = prefix_to_site.get(country_code)
+def _resolve_dag_unique(structure: ProjectStructure, country_code: str) -> str:
+    site = PREFIX_TO_SITE.get(country_code)
 
     if not site:
         raise ValueError(f"Unknown prefix '{country_code}'")
 
-    dags = proj.export_dags()  # [{'data_access_group_name': 'Greece', 'unique_group_name': 'greece'}, ...]
-
-    for dag in dags:
-        if dag.get("unique_group_name", "").lower() == site:
-            return dag["unique_group_name"]
-
-    for dag in dags:
-        if dag.get("data_access_group_name", "").lower() == site:
-            return dag["unique_group_name"]
-
-    norm = lambda s: s.lower().replace(" ", "").replace("_", "").replace("-", "")
-    for dag in dags:
-        if norm(dag.get("data_access_group_name", "")) == norm(site):
-            return dag["unique_group_name"]
-
-    raise RuntimeError(f"No matching DAG for site '{site}'. Exported DAGs: {dags}")
+    dag = structure.resolve_dag(site)
+    if dag is None:
+        raise RuntimeError(f"No matching DAG for site '{site}'. Exported DAGs: {structure.dags}")
+    return dag
 
 
-def _health_code_from_metadata(proj: Project, value: str) -> str:
-    meta = [m for m in proj.export_metadata(fields=[HEALTH_FIELD]) if m.get("field_name") == HEALTH_FIELD]
-    if not meta:
+def _health_code_from_choices(choices: ChoiceIndex, value: str) -> str:
+    fc = choices.get(HEALTH_FIELD)
+    if fc is None:
         raise RuntimeError(
             f"Field '{HEALTH_FIELD}' not found. Make sure the Variable Name is exactly '{HEALTH_FIELD}'.")
-    choices = meta[0].get("select_choices_or_calculations", "")
-    pairs = [p.strip() for p in choices.split("|") if p.strip()]
-    code_by_label = {}
-    code_by_code = {}
-    for p in pairs:
-        if "," not in p:
-            continue
-        code, label = [x.strip() for x in p.split(",", 1)]
-        code_by_code[code.lower()] = code
-        code_by_label[label.lower()] = code
-
-    v = value.strip().lower()
-    if v in code_by_code:
-        return code_by_code[v]
-    if v in code_by_label:
-        return code_by_label[v]
-    synonyms = {"healthy": "healthy", "patient": "patient", "survivor": "survivor"}
-    if v in synonyms and synonyms[v] in code_by_label:
-        return code_by_label[synonyms[v]]
+    code = fc.code_for(value)
+    if code is not None:
+        return code
     raise RuntimeError(
         f"Value '{value}' does not match any choice for '{HEALTH_FIELD}'. "
-        f"Choices are: {choices}"
+        f"Choices are: {fc.choices_string()}"
     )
 
 
+def _health_code_from_metadata(proj: "Project", value: str) -> str:
+    return _health_code_from_choices(metadata_cache.get(proj).choices, value)
+
+
 def _date_only_date(ts: str) -> datetime:
     """
     Parse ISO8601 timestamp into a datetime.date, then return
@@ -94,25 +74,34 @@ def _date_only_date(ts: str) -> datetime:
     return datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
 
 
-def create_record(user_id: str, health_value: str, country_code: str):
-    proj = Project(api_url(BASE_URL), API_TOKEN)
-    record_id_field = proj.def_field
+def build_enrolment_record(structure: ProjectStructure, choices: ChoiceIndex,
+                           user_id: str, health_value: str, country_code: str) -> dict:
+    """Validate one enrolment row against the cached structure and build its REDCap record."""
     if country_code == "TEST":
         _country_code = "EL"
     else:
         _country_code = country_code
 
-    dag_unique = _resolve_dag_unique(proj, _country_code)
-    health_code = _health_code_from_metadata(proj, health_value)
+    dag_unique = _resolve_dag_unique(structure, _country_code)
+    health_code = _health_code_from_choices(choices, health_value)
 
     rec = {
-        record_id_field: user_id,
+        structure.def_field: user_id,
         "redcap_data_access_group": dag_unique,
         HEALTH_FIELD: health_code,
         "registration_complete": 2
     }
-    if proj.is_longitudinal:
-        rec["redcap_event_name"] = proj.export_events()[0]["unique_event_name"]
+    if structure.is_longitudinal:
+        rec["redcap_event_name"] = structure.first_event
+    return rec
+
+
+def create_record(user_id: str, health_value: str, country_code: str):
+    proj = registry.get(api_url(BASE_URL), API_TOKEN)
+    # DAGs, events and choices come from TTL caches, so a warm enrolment is
+    # a single import_records call.
+    rec = build_enrolment_record(structure_cache.get(proj), metadata_cache.get(proj).choices,
+                                 user_id, health_value, country_code)
 
     return proj.import_records(
         [rec],
@@ -122,17 +111,97 @@ def create_record(user_id: str, health_value: str, country_code: str):
     )
 
 
-def choice_map(proj: Project, field: str) -> dict:
-    md = [m for m in proj.export_metadata(fields=[field]) if m.get("field_name") == field]
-    if not md:
-        return {}
-    choices = md[0].get("select_choices_or_calculations", "") or ""
-    out = {}
-    for part in [p.strip() for p in choices.split("|") if p.strip()]:
-        if "," in part:
-            code, label = [x.strip() for x in part.split(",", 1)]
-            out[code] = label
-    return out
+def _returned_ids(content) -> set:
+    # returnContent=ids: a list of ids (some REDCap versions wrap each in {"id": ...})
+    if not isinstance(content, list):
+        return set()
+    return {str(x.get("id")) if isinstance(x, dict) else str(x) for x in content}
+
+
+async def _import_batch(client, batch: List[Tuple[int, dict]], results: List[dict]):
+    """
+    Import one batch. REDCap rejects the whole call if any record is invalid,
+    so a batch that fails validation (4xx) is retried record by record to pin
+    the error on its row. Transport errors and 5xx fail the batch as a whole:
+    splitting would only multiply the load on a REDCap that is already failing.
+    """
+    try:
+        content = await client.import_records([rec for _, rec in batch], overwrite="overwrite",
+                                              return_content="ids", date_format="YMD")
+    except Exception as e:
+        code = getattr(e, "status_code", None)
+        if len(batch) == 1 or not (isinstance(code, int) and 400 <= code < 500):
+            for idx, _ in batch:
+                results[idx].update(status="error", message=str(e))
+            return
+        logger.warning(f"Enrolment batch of {len(batch)} failed ({e}); retrying per record")
+        for item in batch:
+            await _import_batch(client, [item], results)
+        return
+    imported = _returned_ids(content)
+    for idx, _ in batch:
+        user_id = results[idx]["userId"]
+        if user_id in imported:
+            results[idx].update(status="success", record_id=user_id)
+        else:
+            results[idx].update(status="error", message="REDCap did not report this record as imported")
+
+
+async def create_records_bulk(client, rows: Iterable[Dict[str, Any]],
+                              batch_size: int = ENROL_BATCH_SIZE) -> List[dict]:
+    """
+    Enrol many participants: every row is validated against the cached DAGs and
+    HEALTH_FIELD choices, valid ones are sent in import_records batches of
+    `batch_size`. Returns one result per input row, in input order.
+    """
+    structure, meta = await asyncio.gather(structure_cache.aget(client), metadata_cache.aget(client))
+    choices = meta.choices
+
+    results: List[dict] = []
+    valid: List[Tuple[int, dict]] = []
+    seen = set()
+    for idx, row in enumerate(rows):
+        user_id = (row.get("userId") or "").strip()
+        result = {"row": idx, "userId": user_id, "status": "error", "record_id": None, "message": None}
+        results.append(result)
+        if not user_id:
+            result["message"] = "userId is required"
+            continue
+        if user_id in seen:
+            result["message"] = f"Duplicate userId '{user_id}' in upload"
+            continue
+        seen.add(user_id)
+        try:
+            rec = build_enrolment_record(structure, choices, user_id,
+                                         (row.get("health_status") or "").strip(),
+                                         (row.get("country_code") or "").strip())
+        except (ValueError, RuntimeError) as e:
+            result["message"] = str(e)
+            continue
+        result["status"] = "pending"
+        valid.append((idx, rec))
+
+    semaphore = asyncio.Semaphore(ENROL_CONCURRENCY)
+
+    async def run(batch):
+        async with semaphore:
+            await _import_batch(client, batch, results)
+
+    await asyncio.gather(*(run(batch) for batch in chunked(valid, batch_size)))
+    return results
+
+
+def choice_map(proj: "Project", field: str) -> dict:
+    return dict(metadata_cache.get(proj).choices.choice_map(field))
+
+
+def _find_allocation(rows) -> Tuple[Optional[str], Optional[str]]:
+    # First non-empty ALLOC_FIELD value across a record's events/instances
+    for row in rows:
+        v = row.get(ALLOC_FIELD)
+        if v not in (None, "", [], {}):
+            return str(v), row.get("redcap_event_name")
+    return None, None
 
 
 def get_randomization_group(record_id: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
@@ -140,7 +209,10 @@ def get_randomization_group(record_id: str) -> Tuple[Optional[str], Optional[str
     Returns (raw_value, label, event_name) for ALLOC_FIELD.
     If not set yet, returns (None, None, None).
     """
-    proj = Project(api_url(BASE_URL), API_TOKEN)
+    proj = registry.get(api_url(BASE_URL), API_TOKEN)
+    cached = allocation_cache.get(proj.url, proj.token, record_id)
+    if cached is not None:
+        return cached
     record_id_field = proj.def_field
 
     rows = proj.export_records(
@@ -151,24 +223,61 @@ def get_randomization_group(record_id: str) -> Tuple[Optional[str], Optional[str
     if not rows:
         return (None, None, None)
 
-    found_raw: Optional[str] = None
-    found_event: Optional[str] = None
-
-    for row in rows:
-        v = row.get(ALLOC_FIELD)
-        if v not in (None, "", [], {}):
-            found_raw = str(v)
-            found_event = row.get("redcap_event_name")
-            break
-
+    found_raw, found_event = _find_allocation(rows)
     if not found_raw:
         return (None, None, None)
 
-    cmap = choice_map(proj, ALLOC_FIELD)
-    label = cmap.get(found_raw)
+    label = metadata_cache.get(proj).choices.label(ALLOC_FIELD, found_raw)
+    allocation_cache.set(proj.url, proj.token, record_id, (found_raw, label, found_event))
     return (found_raw, label, found_event)
 
 
+async def get_randomization_groups(client, record_ids: Optional[List[str]] = None,
+                                   dag: Optional[str] = None,
+                                   chunk_size: int = REDCAP_EXPORT_CHUNK_SIZE,
+                                   use_cache: bool = True) -> Dict[str, dict]:
+    """
+    Batched get_randomization_group: ALLOC_FIELD for many records (or a whole
+    DAG) via chunked export_records, labelled from the cached choice map.
+    A DAG is first resolved to its record ids (an id-only export), then goes
+    through the same cached, chunked path. Returns {record_id: {"raw",
+    "label", "event_name"}}; unset allocations are None.
+    """
+    meta = await metadata_cache.aget(client)
+    def_field = meta.def_field
+    fields = [def_field, ALLOC_FIELD]
+
+    ids = [str(rid) for rid in await resolve_record_ids(client, def_field, record_ids, dag)]
+    found: Dict[str, Tuple] = {}
+    if use_cache:
+        found.update(allocation_cache.get_many(client.url, client.token, ids))
+    missing = [rid for rid in ids if rid not in found]
+    sem = asyncio.Semaphore(REDCAP_EXPORT_CONCURRENCY)
+
+    async def export_chunk(chunk):
+        async with sem:
+            return await client.export_records(records=chunk, fields=fields, raw_or_label="raw")
+
+    chunks = await asyncio.gather(*(export_chunk(c) for c in chunked(missing, chunk_size)))
+
+    grouped: Dict[str, list] = {}
+    for rows in chunks:
+        for row in rows:
+            grouped.setdefault(str(row.get(def_field)), []).append(row)
+    for rid, rows in grouped.items():
+        raw, event = _find_allocation(rows)
+        if raw is None:
+            continue
+        found[rid] = (raw, meta.choices.label(ALLOC_FIELD, raw), event)
+        allocation_cache.set(client.url, client.token, rid, found[rid])
+
+    result = {}
+    for rid in ids:
+        raw, label, event = found.get(rid, (None, None, None))
+        result[rid] = {"raw": raw, "label": label, "event_name": event}
+    return result
+
+
 def _parse_iso_datetime(ts: str) -> datetime:
     """
     Parse ISO 8601 timestamps like '2025-10-13T09:58:04+00:00' or ending with 'Z'
@@ -180,15 +289,18 @@ def _parse_iso_datetime(ts: str) -> datetime:
         raise ValueError(f"Invalid ISO8601 timestamp: {ts}") from e
 
 
+_RESPONSE_DOC_DATES = ("timestamp", "createdAt", "updatedAt")
+
+
 def _serialize_response_doc(doc: dict) -> dict:
-    # Convert Mongo types to JSON-friendly values
+    # Convert Mongo types to JSON-friendly values; only the keys that need it
+    # are touched
     d = dict(doc)
-    if "_id" in d:
-        d["_id"] = str(d["_id"])
-    for k in ("timestamp", "createdAt", "updatedAt"):
-        if k in d and d[k] is not None:
-            try:
-                d[k] = d[k].isoformat()
-            except Exception:
-                pass
+    _id = d.get("_id")
+    if _id is not None and not isinstance(_id, str):
+        d["_id"] = str(_id)
+    for k in _RESPONSE_DOC_DATES:
+        v = d.get(k)
+        if isinstance(v, (datetime, date)):
+            d[k] = v.isoformat()
     return d
@@ -0,0 +1,101 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from metadata_cache import metadata_cache
+from project_structure import structure_cache
+
+
+logger = logging.getLogger("redcap-utils")
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_RETRY_S = float(os.getenv("WARMUP_RETRY_S", "5"))
+WARMUP_RETRY_MAX_S = float(os.getenv("WARMUP_RETRY_MAX_S", "60"))
+
+PENDING, WARMING, READY, FAILED, DISABLED = "pending", "warming", "ready", "failed", "disabled"
+
+
+class Warmup:
+    """
+    Prefetches everything the hot paths read from REDCap (metadata and
+    field labels, DAGs, events, HEALTH_FIELD/ALLOC_FIELD choices) right after
+    startup, retrying with backoff until it succeeds. `ready` backs the
+    readiness endpoint.
+    """
+
+    def __init__(self):
+        self.status = PENDING
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.duration_ms: Optional[float] = None
+        self.details: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status in (READY, DISABLED)
+
+    async def warm(self, client, choice_fields) -> Dict[str, Any]:
+        """One warm-up pass; raises if REDCap or a required field is unavailable."""
+        # structure_cache also needs the metadata; single-flight makes that one export
+        entry, structure = await asyncio.gather(metadata_cache.aget(client), structure_cache.aget(client))
+        choices = entry.choices
+        missing = [f for f in choice_fields if f and choices.get(f) is None]
+        if missing:
+            raise RuntimeError(f"Coded fields missing from the project metadata: {missing}")
+        return {
+            "metadata_version": entry.version,
+            "fields": len(entry.fields),
+            "field_labels": len(entry.field_labels),
+            "dags": len(structure.dags),
+            "events": len(structure.events),
+            "choice_maps": {f: len(choices.choice_map(f)) for f in choice_fields if f},
+        }
+
+    async def _run(self, client_factory, choice_fields):
+        delay = WARMUP_RETRY_S
+        while True:
+            self.status = WARMING
+            self.attempts += 1
+            t0 = time.perf_counter()
+            try:
+                self.details = await self.warm(client_factory(), choice_fields)
+            except Exception as e:
+                self.status, self.error = FAILED, str(e)
+                logger.warning(f"Cache warm-up attempt {self.attempts} failed, retrying in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WARMUP_RETRY_MAX_S)
+                continue
+            self.duration_ms = round((time.perf_counter() - t0) * 1000, 1)
+            self.status, self.error = READY, None
+            logger.info(f"Caches warm in {self.duration_ms} ms: {self.details}")
+            return
+
+    def start(self, client_factory, choice_fields=()):
+        """Warm up in the background (called from the app lifespan)."""
+        if not WARMUP_ENABLED:
+            self.status = DISABLED
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(client_factory, tuple(choice_fields)))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "ready": self.ready,
+            "attempts": self.attempts,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+            "caches": self.details,
+        }
+
+
+warmup = Warmup()
@@ -0,0 +1,316 @@
+"""
+Durable SQLite work queue for REDCap webhooks (Data Entry Trigger /
+completion callbacks).
+
+The endpoint only appends the payload and acknowledges; a pool of async
+workers drains the queue, retrying failures with backoff and moving jobs
+that keep failing (or fail permanently with a 4xx) to the dead-letter state.
+A claimed job carries its owner and a lease that the worker renews while it
+runs; once the lease expires (the owner crashed or was killed) any process
+sharing the database may claim the job again.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger("redcap-utils")
+
+# State that must survive restarts lives under DATA_DIR (a volume in the container)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+WEBHOOK_QUEUE_DB = os.getenv("WEBHOOK_QUEUE_DB", os.path.join(DATA_DIR, "webhook_queue.db"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_RETRY_BASE_S = float(os.getenv("WEBHOOK_RETRY_BASE_S", "2"))
+WEBHOOK_RETRY_MAX_S = float(os.getenv("WEBHOOK_RETRY_MAX_S", "300"))
+WEBHOOK_POLL_S = float(os.getenv("WEBHOOK_POLL_S", "1"))
+# How long a claimed job stays reserved without a heartbeat from its worker
+WEBHOOK_LEASE_S = float(os.getenv("WEBHOOK_LEASE_S", "60"))
+
+PENDING, PROCESSING, DONE, DEAD = "pending", "processing", "done", "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    result TEXT,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS webhook_jobs_ready ON webhook_jobs (status, available_at);
+"""
+
+# Columns added after the first release; created on open if missing
+_LEASE_COLUMNS = (("owner", "TEXT"), ("lease_until", "REAL"))
+
+# A processing job whose lease has lapsed (NULL: claimed before leases existed)
+_EXPIRED = "status = 'processing' AND (lease_until IS NULL OR lease_until < ?)"
+
+
+def idempotency_key(payload: Dict[str, Any]) -> str:
+    """(record_id, instrument, timestamp); payloads without a timestamp are never deduplicated."""
+    record_id = payload.get("record_id") or payload.get("record")
+    timestamp = payload.get("timestamp")
+    if not timestamp:
+        return f"{record_id}|{payload.get('instrument')}|{uuid.uuid4().hex}"
+    return f"{record_id}|{payload.get('instrument')}|{timestamp}"
+
+
+def _permanent(error: Exception) -> bool:
+    # HTTP-style client errors won't succeed on retry (429 excepted)
+    code = getattr(error, "status_code", None)
+    return isinstance(code, int) and 400 <= code < 500 and code != 429
+
+
+class WebhookQueue:
+    def __init__(self, path: str = WEBHOOK_QUEUE_DB, max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+                 lease: float = WEBHOOK_LEASE_S):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease = lease
+        # Identifies this process's claims; other processes never touch them while the lease holds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        columns = {r["name"] for r in self._conn.execute("PRAGMA table_info(webhook_jobs)")}
+        for name, sql_type in _LEASE_COLUMNS:
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE webhook_jobs ADD COLUMN {name} {sql_type}")
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._stopping = False
+
+    # --- storage (blocking; run via asyncio.to_thread) ---
+
+    def _enqueue(self, payload: Dict[str, Any]) -> Tuple[int, bool]:
+        now = time.time()
+        key = idempotency_key(payload)
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO webhook_jobs (idem_key, payload, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(payload, ensure_ascii=False, default=str), PENDING, now, now, now),
+            )
+            if cur.rowcount:
+                return cur.lastrowid, False
+            row = self._conn.execute("SELECT id FROM webhook_jobs WHERE idem_key = ?", (key,)).fetchone()
+            return row["id"], True
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the database write lock, so two processes cannot
+            # claim the same row
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT * FROM webhook_jobs WHERE (status = ? AND available_at <= ?) OR ({_EXPIRED}) "
+                    "ORDER BY id LIMIT 1",
+                    (PENDING, now, now),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE webhook_jobs SET status = ?, attempts = attempts + 1, owner = ?, lease_until = ?, "
+                        "updated_at = ? WHERE id = ?",
+                        (PROCESSING, self.owner, now + self.lease, now, row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _extend(self, job_id: int) -> bool:
+        """Renew this process's lease on a job; False if it was lost to another owner."""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE webhook_jobs SET lease_until = ? WHERE id = ? AND status = ? AND owner = ?",
+                (now + self.lease, job_id, PROCESSING, self.owner),
+            )
+        return bool(cur.rowcount)
+
+    def _finish(self, job_id: int, result: Any) -> bool:
+        # Only the current lease holder may settle a job
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE webhook_jobs SET status = ?, result = ?, last_error = NULL, owner = NULL, lease_until = NULL, "
+                "updated_at = ? WHERE id = ? AND status = ? AND owner = ?",
+                (DONE, json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id,
+                 PROCESSING, self.owner),
+            )
+        return bool(cur.rowcount)
+
+    def _fail(self, job_id: int, attempts: int, error: str, permanent: bool) -> Optional[str]:
+        now = time.time()
+        if permanent or attempts >= self.max_attempts:
+            status, available_at = DEAD, now
+        else:
+            status = PENDING
+            available_at = now + min(WEBHOOK_RETRY_MAX_S, WEBHOOK_RETRY_BASE_S * 2 ** (attempts - 1))
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE webhook_jobs SET status = ?, available_at = ?, last_error = ?, owner = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ? AND status = ? AND owner = ?",
+                (status, available_at, error, now, job_id, PROCESSING, self.owner),
+            )
+        return status if cur.rowcount else None
+
+    def _recover(self) -> int:
+        """Return jobs whose lease expired to the pending state; live leases are left alone."""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                f"UPDATE webhook_jobs SET status = ?, available_at = ?, owner = NULL, lease_until = NULL "
+                f"WHERE {_EXPIRED}",
+                (PENDING, now, now),
+            )
+        return cur.rowcount
+
+    def _depth(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {r["status"]: r["n"] for r in self._conn.execute(
+                "SELECT status, COUNT(*) AS n FROM webhook_jobs GROUP BY status")}
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) AS t FROM webhook_jobs WHERE status IN (?, ?)", (PENDING, PROCESSING)
+            ).fetchone()["t"]
+        return {
+            PENDING: counts.get(PENDING, 0),
+            PROCESSING: counts.get(PROCESSING, 0),
+            DONE: counts.get(DONE, 0),
+            DEAD: counts.get(DEAD, 0),
+            "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0.0,
+            "workers": len(self._workers),
+        }
+
+    def _dead_letters(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, idem_key, payload, attempts, last_error, updated_at FROM webhook_jobs "
+                "WHERE status = ? ORDER BY id DESC LIMIT ?", (DEAD, limit)
+            ).fetchall()
+        return [{**dict(r), "payload": json.loads(r["payload"])} for r in rows]
+
+    def _requeue(self, job_id: int) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE webhook_jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = ?",
+                (PENDING, time.time(), time.time(), job_id, DEAD),
+            )
+        return bool(cur.rowcount)
+
+    # --- async API ---
+
+    async def enqueue(self, payload: Dict[str, Any]) -> Tuple[int, bool]:
+        """Persist a payload; returns (job_id, duplicate)."""
+        job_id, duplicate = await asyncio.to_thread(self._enqueue, payload)
+        if not duplicate and self._wakeup is not None:
+            self._wakeup.set()
+        return job_id, duplicate
+
+    async def depth(self) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._depth)
+
+    async def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._dead_letters, limit)
+
+    async def requeue(self, job_id: int) -> bool:
+        ok = await asyncio.to_thread(self._requeue, job_id)
+        if ok and self._wakeup is not None:
+            self._wakeup.set()
+        return ok
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Awaitable[Any]], workers: int = WEBHOOK_WORKERS):
+        recovered = await asyncio.to_thread(self._recover)
+        if recovered:
+            logger.info(f"Webhook queue: re-queued {recovered} jobs whose lease expired")
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(handler, i)) for i in range(workers)]
+        logger.info(f"Webhook queue started ({workers} workers, db={self.path})")
+
+    async def stop(self):
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._conn.close()
+        logger.info("Webhook queue stopped")
+
+    async def _worker(self, handler, n: int):
+        while not self._stopping:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), WEBHOOK_POLL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._heartbeat(job["id"]))
+            try:
+                result = await handler(json.loads(job["payload"]))
+            except Exception as e:
+                status = await asyncio.to_thread(self._fail, job["id"], job["attempts"] + 1,
+                                                 repr(e), _permanent(e))
+                if status is None:
+                    logger.warning(f"Webhook job {job['id']} failed after its lease was lost: {e!r}")
+                else:
+                    log = logger.error if status == DEAD else logger.warning
+                    log(f"Webhook job {job['id']} failed (attempt {job['attempts'] + 1}, now {status}): {e!r}")
+                continue
+            finally:
+                heartbeat.cancel()
+
+            if hasattr(result, "model_dump"):
+                result = result.model_dump()
+            if not await asyncio.to_thread(self._finish, job["id"], result):
+                logger.warning(f"Webhook job {job['id']} finished after its lease was lost; result not recorded")
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not await asyncio.to_thread(self._extend, job_id):
+                logger.warning(f"Webhook job {job_id}: lease lost")
+                return
+
+
+webhook_queue: Optional[WebhookQueue] = None
+
+
+def open_webhook_queue() -> WebhookQueue:
+    global webhook_queue
+    if webhook_queue is None:
+        webhook_queue = WebhookQueue()
+    return webhook_queue
+
+
+async def close_webhook_queue():
+    global webhook_queue
+    if webhook_queue is not None:
+        await webhook_queue.stop()
+        webhook_queue = None
@@ -0,0 +1,70 @@
+"""
+Microbenchmark for response serialization of a labelled record export
+(the /get-redcap-responses payload).
+
+Compares FastAPI's default path (jsonable_encoder + stdlib json, as
+JSONResponse renders it) with app/serialization.py (orjson when installed)
+and with a record-cache hit, which sends the bytes CacheEntry already holds,
+plain or gzip-compressed.
+
+    python benchmarks/bench_json.py --rows 200 --fields 300
+"""
+import os
+import sys
+import json
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+import serialization  # noqa: E402
+from b4u_utils import label_records  # noqa: E402
+from compression import compress  # noqa: E402
+from record_cache import CacheEntry  # noqa: E402
+from bench_label_transform import make_export  # noqa: E402
+
+
+def stdlib_response(payload) -> bytes:
+    # What fastapi.responses.JSONResponse does for a returned list of dicts
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200, help="instrument instances in the record")
+    parser.add_argument("--fields", type=int, default=300)
+    parser.add_argument("--fill", type=float, default=0.3, help="fraction of non-empty values")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20, help="calls per timing")
+    args = parser.parse_args()
+
+    records, field_labels = make_export(args.rows, args.fields, args.fill)
+    payload = label_records(records, field_labels, "EL0001")
+    assert json.loads(stdlib_response(payload)) == serialization.loads(serialization.dumps(payload))
+
+    entry = CacheEntry(payload)
+    entry.encoded(coding="gzip")  # populated by the first request for the key
+    cases = [
+        ("jsonable_encoder + json", lambda: stdlib_response(payload)),
+        ("json only", lambda: json.dumps(payload, ensure_ascii=False).encode("utf-8")),
+        ("serialization.dumps", lambda: serialization.dumps(payload)),
+        ("dumps + gzip", lambda: compress(serialization.dumps(payload), "gzip")),
+        ("cached bytes", lambda: entry.encoded()),
+        ("cached gzip bytes", lambda: entry.encoded(coding="gzip")),
+    ]
+    size = len(entry.encoded())
+    print(f"{args.rows} rows x {args.fields} fields, fill={args.fill}: {size / 1024:.0f} KiB JSON, "
+          f"{len(entry.encoded(coding='gzip')) / 1024:.0f} KiB gzip; "
+          f"encoder: {'orjson' if serialization.orjson else 'stdlib json'}")
+    baseline = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / args.number
+        baseline = baseline or best
+        print(f"{name:>24}: {best * 1e6:10.1f} us  ({baseline / best:9.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Microbenchmark for the record labelling transform in app/b4u_utils.py.
+
+Compares the original per-field loop (kept verbatim below as the baseline)
+against label_records / label_records_columnar on a synthetic export.
+
+    python benchmarks/bench_label_transform.py --rows 2000 --fields 300
+"""
+import os
+import sys
+import argparse
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from b4u_utils import label_records, label_records_columnar  # noqa: E402
+
+
+def legacy_label_records(records, field_labels, record_id):
+    data = []
+    for record in records:
+        instrument_dict = {}
+
+        instrument = record.get('redcap_repeat_instrument', 'Main Record')
+        instance = record.get('redcap_repeat_instance')
+
+        instrument_dict["Record ID"] = record_id
+        instrument_dict["Repeat Instrument"] = instrument
+        instrument_dict["Repeat Instance"] = instance
+
+        fields = []
+        for field_name, value in record.items():
+            if field_name in [
+                'record_id',
+                'redcap_repeat_instrument',
+                'redcap_repeat_instance'
+            ]:
+                continue
+
+            if value == "" or value is None:
+                continue
+
+            fields.append({
+                "field_label": field_labels.get(field_name, field_name),
+                "value": value
+            })
+
+            instrument_dict[field_labels.get(field_name, field_name)] = value
+        data.append(instrument_dict)
+
+    return data
+
+
+def make_export(n_rows, n_fields, fill, seed=0):
+    rnd = random.Random(seed)
+    names = [f"field_{i}" for i in range(n_fields)]
+    field_labels = {n: f"Question {i}: how often did you ...?" for i, n in enumerate(names)}
+    records = []
+    for r in range(n_rows):
+        row = {"record_id": "EL0001", "redcap_repeat_instrument": "daily", "redcap_repeat_instance": r + 1}
+        for n in names:
+            row[n] = str(rnd.randint(0, 5)) if rnd.random() < fill else ""
+        records.append(row)
+    return records, field_labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--fields", type=int, default=300)
+    parser.add_argument("--fill", type=float, default=0.3, help="fraction of non-empty values")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records, field_labels = make_export(args.rows, args.fields, args.fill)
+    assert legacy_label_records(records, field_labels, "EL0001") == label_records(records, field_labels, "EL0001")
+
+    cases = [
+        ("legacy", lambda: legacy_label_records(records, field_labels, "EL0001")),
+        ("label_records", lambda: label_records(records, field_labels, "EL0001")),
+        ("label_records_columnar", lambda: label_records_columnar(records, field_labels, "EL0001")),
+    ]
+    print(f"{args.rows} rows x {args.fields} fields, fill={args.fill}")
+    baseline = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:>24}: {best * 1000:8.1f} ms  ({baseline / best:4.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Load test for the API against the local REDCap simulator (redcap_sim.py).
+
+Starts the simulator and the service (uvicorn main:app, pointed at the
+simulator) as subprocesses, then drives each scenario at a fixed concurrency
+and reports throughput, latency percentiles and the service's memory:
+
+- responses      GET /get-redcap-responses (record cache warm after the first pass)
+- responses_cold GET /get-redcap-responses?refresh=true (every request hits REDCap)
+- enrol          POST /create-records with --enrol-rows rows per request
+- randomization  POST /randomization-groups for --rand-ids records (use_cache=false)
+
+    python benchmarks/bench_load.py --requests 2000 --concurrency 32 --latency-ms 50
+    python benchmarks/bench_load.py --scenarios responses --max-p95-ms 250   # exits 1 on regression
+
+Use --target http://host:port to drive an already running service instead
+(memory is then only reported when --pid is given).
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+import subprocess
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "..", "app")
+AUTH = (os.getenv("API_USER", "admin"), os.getenv("API_PASS", "changeme"))
+# The simulator ignores the token, but PyCap rejects anything that is not 32 hex chars
+SIM_TOKEN = "0" * 32
+SCENARIOS = ("responses", "responses_cold", "enrol", "randomization")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: Optional[int]) -> Dict[str, Optional[float]]:
+    """Current and peak resident memory of `pid` from /proc (Linux only)."""
+    out = {"rss_mb": None, "peak_rss_mb": None}
+    if pid is None:
+        return out
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    out["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    out["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return out
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+async def wait_ready(url: str, timeout: float = 30, **kwargs):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                resp = await client.request(url=url, **kwargs)
+                if resp.status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_processes(args) -> Dict[str, subprocess.Popen]:
+    sim_port, app_port = free_port(), free_port()
+    sim_env = {**os.environ,
+               "SIM_RECORDS": str(args.records), "SIM_REPEATS": str(args.repeats),
+               "SIM_FIELDS": str(args.fields), "SIM_LATENCY_MS": str(args.latency_ms),
+               "SIM_JITTER_MS": str(args.jitter_ms)}
+    sim = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "redcap_sim:app", "--port", str(sim_port), "--log-level", "warning"],
+        cwd=HERE, env=sim_env)
+
+    app_env = {**os.environ,
+               "BASE_URL": f"http://127.0.0.1:{sim_port}/", "API_TOKEN": SIM_TOKEN,
+               "HEALTH_FIELD": "health_status", "ALLOC_FIELD": "randomization",
+               "API_USER": AUTH[0], "API_PASS": AUTH[1],
+               "WEBHOOK_QUEUE_DB": os.path.join(args.workdir, "bench_webhook_queue.db"),
+               "SYNC_DB_URL": f"sqlite:///{os.path.join(args.workdir, 'bench_sync.db')}"}
+    app_env.pop("MONGODB_URI", None)
+    # The service logs every REDCap call; keep that out of the report
+    log = open(os.path.join(args.workdir, "bench_service.log"), "w")
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"],
+        cwd=APP_DIR, env=app_env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"Service log: {log.name}")
+
+    args.sim_url = f"http://127.0.0.1:{sim_port}"
+    args.target = f"http://127.0.0.1:{app_port}"
+    args.pid = service.pid
+    return {"sim": sim, "service": service}
+
+
+def make_scenario(name: str, args, counter) -> Callable[[httpx.AsyncClient], Awaitable[httpx.Response]]:
+    rnd = random.Random(0)
+    ids = [str(i) for i in range(1, args.records + 1)]
+
+    if name == "responses":
+        return lambda c: c.get("/get-redcap-responses", params={"record_id": rnd.choice(ids)})
+    if name == "responses_cold":
+        return lambda c: c.get("/get-redcap-responses", params={"record_id": rnd.choice(ids), "refresh": "true"})
+    if name == "enrol":
+        sites = ["EL", "LT", "ES", "SE"]
+
+        def enrol(c):
+            rows = [{"userId": f"BENCH-{next(counter)}", "health_status": rnd.choice(["Healthy", "Patient"]),
+                     "country_code": rnd.choice(sites)} for _ in range(args.enrol_rows)]
+            return c.post("/create-records", json={"rows": rows})
+        return enrol
+    if name == "randomization":
+        return lambda c: c.post("/randomization-groups", params={"use_cache": "false"},
+                                json={"record_ids": rnd.sample(ids, min(args.rand_ids, len(ids)))})
+    raise ValueError(f"unknown scenario {name}")
+
+
+async def run_scenario(name: str, args, counter) -> dict:
+    send = make_scenario(name, args, counter)
+    latencies: List[float] = []
+    errors = 0
+    remaining = itertools.count()
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.target, auth=AUTH, limits=limits, timeout=60) as client:
+        for _ in range(args.warmup):
+            await send(client)
+
+        async def worker():
+            nonlocal errors
+            while next(remaining) < args.requests:
+                t0 = time.perf_counter()
+                try:
+                    resp = await send(client)
+                    ok = resp.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - t0)
+                if not ok:
+                    errors += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        **rss_mb(args.pid),
+    }
+
+
+def print_table(results: List[dict]):
+    cols = ["scenario", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "rss_mb", "peak_rss_mb"]
+    print("  ".join(f"{c:>14}" for c in cols))
+    for r in results:
+        print("  ".join(f"{str(r[c]):>14}" for c in cols))
+
+
+async def main_async(args) -> List[dict]:
+    await wait_ready(f"{args.target}/ready", method="GET", auth=AUTH)
+    print(f"Service at {args.target} (pid {args.pid}), idle: {rss_mb(args.pid)}")
+    counter = itertools.count()
+    results = []
+    for name in args.scenarios:
+        results.append(await run_scenario(name, args, counter))
+        print(f"  {name}: done")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20, help="Sequential requests before measuring")
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=4)
+    parser.add_argument("--fields", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=20, help="Simulated REDCap latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--enrol-rows", type=int, default=1)
+    parser.add_argument("--rand-ids", type=int, default=50)
+    parser.add_argument("--target", help="Drive an already running service instead of starting one")
+    parser.add_argument("--pid", type=int, help="Service pid for memory numbers (with --target)")
+    parser.add_argument("--workdir", default=os.getenv("TMPDIR", "/tmp"))
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit 1 if any scenario's p95 exceeds this")
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="Exit 1 above this error ratio")
+    args = parser.parse_args()
+
+    procs = {} if args.target else start_processes(args)
+    try:
+        results = asyncio.run(main_async(args))
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = [r["scenario"] for r in results
+              if (args.max_p95_ms is not None and r["p95_ms"] > args.max_p95_ms)
+              or r["errors"] > args.max_error_rate * r["requests"]]
+    if failed:
+        print(f"FAILED budget: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Startup-time report and regression check for the API process.
+
+Imports app/main.py in fresh interpreters (as a uvicorn worker does) and
+reports the median import time, the lifespan startup time and the most
+expensive imports (from `python -X importtime`). Exits 1 when the median
+import exceeds --budget-ms, or when a dependency that is supposed to be
+loaded lazily (pandas, PyCap, pymongo/motor, sqlalchemy, httpx) is pulled in
+by `import main`.
+
+    python benchmarks/bench_startup.py --runs 5 --budget-ms 1500
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+from typing import Dict, List, Tuple
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "..", "app")
+LAZY_MODULES = ("pandas", "redcap", "requests", "pymongo", "motor", "sqlalchemy", "httpx")
+
+PROBE = """
+import sys, time, json, asyncio
+t0 = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - t0) * 1000
+loaded = [m for m in %r if m in sys.modules]
+
+async def run_lifespan():
+    async with main.lifespan(main.app):
+        pass
+
+lifespan_ms = None
+if %r:
+    asyncio.run(run_lifespan())
+    lifespan_ms = main.startup.get("lifespan_ms")
+print(json.dumps({"import_ms": import_ms, "lifespan_ms": lifespan_ms, "loaded": loaded}))
+"""
+
+
+def probe_env(workdir: str) -> Dict[str, str]:
+    env = {**os.environ, "WEBHOOK_QUEUE_DB": os.path.join(workdir, "startup_webhook_queue.db")}
+    env.pop("MONGODB_URI", None)
+    return env
+
+
+def run_probe(env: Dict[str, str], lifespan: bool) -> dict:
+    out = subprocess.run([sys.executable, "-c", PROBE % (LAZY_MODULES, lifespan)],
+                         cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def import_costs(env: Dict[str, str]) -> List[Tuple[str, int, int]]:
+    """(module, self_us, cumulative_us) for top-level imports of `import main`."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                         cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[0].startswith("import time:"):
+            continue
+        self_us = parts[0].replace("import time:", "").strip()
+        if not self_us.isdigit():
+            continue  # header line
+        name = parts[2].strip()
+        # One leading space plus two per nesting level: main itself is at
+        # level 0, its direct imports at level 1
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if name == "main" or depth == 1:
+            rows.append((name, int(self_us), int(parts[1])))
+    return sorted(rows, key=lambda r: r[2], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "1500")),
+                        help="Fail if the median `import main` takes longer")
+    parser.add_argument("--top", type=int, default=15, help="Rows in the per-import table")
+    parser.add_argument("--no-lifespan", action="store_true", help="Skip measuring the lifespan startup")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = probe_env(workdir)
+        # The first run warms the OS page cache and .pyc files
+        run_probe(env, lifespan=False)
+        runs = [run_probe(env, lifespan=not args.no_lifespan) for _ in range(args.runs)]
+        costs = import_costs(env)
+
+    import_ms = statistics.median(r["import_ms"] for r in runs)
+    lifespans = [r["lifespan_ms"] for r in runs if r["lifespan_ms"] is not None]
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+
+    print(f"{'import':<28}{'self ms':>10}{'cumulative ms':>16}")
+    for name, self_us, cumulative_us in costs[:args.top]:
+        print(f"{name:<28}{self_us / 1000:>10.1f}{cumulative_us / 1000:>16.1f}")
+    print()
+    print(f"import main (median of {args.runs}): {import_ms:.1f} ms  (budget {args.budget_ms:.0f} ms)")
+    if lifespans:
+        print(f"lifespan startup (median):     {statistics.median(lifespans):.1f} ms")
+    print(f"lazy dependencies loaded by import: {loaded or 'none'}")
+
+    failures = []
+    if import_ms > args.budget_ms:
+        failures.append(f"import time {import_ms:.1f} ms exceeds budget {args.budget_ms:.0f} ms")
+    if loaded:
+        failures.append(f"`import main` eagerly loads {loaded}")
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
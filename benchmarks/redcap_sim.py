@@ -0,0 +1,267 @@
+"""
+Local stand-in for the REDCap API, for load tests that must not touch the
+production REDCap at BASE_URL.
+
+Serves the calls this service makes (content=metadata, record export/import,
+dag, event, log, project) over the same form-encoded POST /api/ interface,
+from a synthetic in-memory project:
+
+- SIM_RECORDS      participants (default 500)
+- SIM_REPEATS      instances of the repeating "weekly_survey" per record (default 4)
+- SIM_FIELDS       questions on weekly_survey (default 40)
+- SIM_LONGITUDINAL 1 to expose two events (default 0, classic project)
+- SIM_LATENCY_MS   base delay added to every call (default 0)
+- SIM_JITTER_MS    extra uniform random delay (default 0)
+- SIM_SEED         RNG seed for the generated answers (default 0)
+
+    python benchmarks/redcap_sim.py --port 8081 --records 2000 --latency-ms 80
+    # then BASE_URL=http://127.0.0.1:8081/ API_TOKEN=00000000000000000000000000000000 \
+    #      HEALTH_FIELD=health_status ALLOC_FIELD=randomization
+
+Any 32-character token works: the simulator ignores it, but PyCap validates
+the length before sending anything.
+"""
+import os
+import json
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+SIM_RECORDS = int(os.getenv("SIM_RECORDS", "500"))
+SIM_REPEATS = int(os.getenv("SIM_REPEATS", "4"))
+SIM_FIELDS = int(os.getenv("SIM_FIELDS", "40"))
+SIM_LONGITUDINAL = os.getenv("SIM_LONGITUDINAL", "0") == "1"
+SIM_LATENCY_MS = float(os.getenv("SIM_LATENCY_MS", "0"))
+SIM_JITTER_MS = float(os.getenv("SIM_JITTER_MS", "0"))
+SIM_SEED = int(os.getenv("SIM_SEED", "0"))
+
+HEALTH_FIELD = "health_status"
+ALLOC_FIELD = "randomization"
+REPEAT_FORM = "weekly_survey"
+
+DAGS = [
+    {"data_access_group_name": "Greece", "unique_group_name": "greece"},
+    {"data_access_group_name": "Lithuania", "unique_group_name": "lithuania"},
+    {"data_access_group_name": "Spain", "unique_group_name": "spain"},
+    {"data_access_group_name": "Sweden", "unique_group_name": "sweden"},
+]
+EVENTS = [
+    {"event_name": "Baseline", "arm_num": 1, "unique_event_name": "baseline_arm_1"},
+    {"event_name": "Follow up", "arm_num": 1, "unique_event_name": "follow_up_arm_1"},
+]
+SYSTEM_COLUMNS = ("redcap_event_name", "redcap_repeat_instrument", "redcap_repeat_instance",
+                  "redcap_data_access_group")
+
+
+def _field(name, form, ftype, label, choices=""):
+    return {"field_name": name, "form_name": form, "section_header": "", "field_type": ftype,
+            "field_label": label, "select_choices_or_calculations": choices, "field_note": "",
+            "text_validation_type_or_show_slider_number": "", "required_field": "",
+            "branching_logic": "", "field_annotation": ""}
+
+
+def build_metadata(n_fields: int) -> List[Dict[str, Any]]:
+    meta = [
+        _field("record_id", "registration", "text", "Record ID"),
+        _field(HEALTH_FIELD, "registration", "radio", "Health status", "1, Healthy | 2, Patient"),
+        _field(ALLOC_FIELD, "randomization", "dropdown", "Allocation", "1, Control | 2, Intervention"),
+    ]
+    for i in range(n_fields):
+        if i % 3 == 2:
+            meta.append(_field(f"q{i}", REPEAT_FORM, "text", f"Question {i}: anything else to add?"))
+        else:
+            meta.append(_field(f"q{i}", REPEAT_FORM, "radio", f"Question {i}: how often did you ...?",
+                               "1, Never | 2, Sometimes | 3, Often | 4, Always"))
+    return meta
+
+
+class SimProject:
+    """Synthetic project data plus the REDCap semantics the API handlers need."""
+
+    def __init__(self, n_records: int, n_repeats: int, n_fields: int, longitudinal: bool, seed: int):
+        self.rnd = random.Random(seed)
+        self.metadata = build_metadata(n_fields)
+        self.fields = {f["field_name"]: f for f in self.metadata}
+        self.form_of = {f["field_name"]: f["form_name"] for f in self.metadata}
+        self.labels = {
+            f["field_name"]: dict(p.split(", ", 1) for p in f["select_choices_or_calculations"].split(" | "))
+            for f in self.metadata if f["select_choices_or_calculations"]
+        }
+        self.events = EVENTS if longitudinal else []
+        self.n_repeats = n_repeats
+        # record_id -> rows (raw); insertion order is REDCap's record order
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+        for i in range(1, n_records + 1):
+            self._create(str(i), {
+                "redcap_data_access_group": DAGS[i % len(DAGS)]["unique_group_name"],
+                HEALTH_FIELD: str(1 + i % 2),
+                # Two thirds of the participants are already randomized
+                ALLOC_FIELD: str(1 + i % 2) if i % 3 else "",
+            }, with_surveys=True)
+
+    def _blank(self) -> Dict[str, Any]:
+        row = {name: "" for name in self.fields}
+        row.update({"redcap_repeat_instrument": "", "redcap_repeat_instance": ""})
+        if self.events:
+            row["redcap_event_name"] = self.events[0]["unique_event_name"]
+        return row
+
+    def _create(self, record_id: str, values: Dict[str, Any], with_surveys: bool = False):
+        base = self._blank()
+        base.update(values)
+        base["record_id"] = record_id
+        rows = [base]
+        if with_surveys:
+            for inst in range(1, self.n_repeats + 1):
+                row = self._blank()
+                row.update({"record_id": record_id, "redcap_repeat_instrument": REPEAT_FORM,
+                            "redcap_repeat_instance": inst,
+                            "redcap_data_access_group": base["redcap_data_access_group"]})
+                for name, form in self.form_of.items():
+                    if form != REPEAT_FORM:
+                        continue
+                    if name in self.labels:
+                        row[name] = str(self.rnd.randint(1, 4))
+                    elif self.rnd.random() < 0.3:
+                        row[name] = f"free text answer {self.rnd.randint(0, 10 ** 6)}"
+                rows.append(row)
+        self.records[record_id] = rows
+
+    def export_records(self, form: Dict[str, str]) -> List[Dict[str, Any]]:
+        ids = _array(form, "records") or list(self.records)
+        fields = _array(form, "fields")
+        forms = _array(form, "forms")
+        label = form.get("rawOrLabel") == "label"
+        with_dag = form.get("exportDataAccessGroups") == "true"
+
+        keep: Optional[set] = None
+        if fields or forms:
+            keep = {"record_id", *fields, *(n for n, f in self.form_of.items() if f in forms)}
+
+        out = []
+        for rid in ids:
+            for row in self.records.get(rid, ()):
+                if keep is not None:
+                    if row["redcap_repeat_instrument"] and not any(
+                            self.form_of.get(k) == row["redcap_repeat_instrument"] for k in keep):
+                        continue
+                    row = {k: v for k, v in row.items() if k in keep or k in SYSTEM_COLUMNS}
+                else:
+                    row = dict(row)
+                if not with_dag:
+                    row.pop("redcap_data_access_group", None)
+                if label:
+                    for k, v in row.items():
+                        choices = self.labels.get(k)
+                        if choices and v != "":
+                            row[k] = choices.get(str(v), v)
+                out.append(row)
+        return out
+
+    def import_records(self, form: Dict[str, str]):
+        data = json.loads(form.get("data") or "[]")
+        dag_names = {d["unique_group_name"] for d in DAGS}
+        for rec in data:
+            if not rec.get("record_id"):
+                return 400, {"error": "The record ID field (record_id) is missing"}
+            dag = rec.get("redcap_data_access_group")
+            if dag and dag not in dag_names:
+                return 400, {"error": f"The value '{dag}' is not a valid Data Access Group"}
+            for name, value in rec.items():
+                if name in self.labels and value not in ("", None) and str(value) not in self.labels[name]:
+                    return 400, {"error": f"{rec['record_id']}: '{value}' is not a valid choice for {name}"}
+        for rec in data:
+            rid = str(rec["record_id"])
+            if rid in self.records:
+                self.records[rid][0].update(rec)
+            else:
+                self._create(rid, rec)
+        if form.get("returnContent") == "ids":
+            return 200, [str(r["record_id"]) for r in data]
+        return 200, {"count": len(data)}
+
+
+def _array(form: Dict[str, str], key: str) -> List[str]:
+    # REDCap arrays arrive as fields[0]=..&fields[1]=.. (or comma separated)
+    values = [v for k, v in form.items() if k.startswith(f"{key}[")]
+    if not values and form.get(key):
+        values = form[key].split(",")
+    return values
+
+
+project = SimProject(SIM_RECORDS, SIM_REPEATS, SIM_FIELDS, SIM_LONGITUDINAL, SIM_SEED)
+calls: Dict[str, int] = {}
+
+
+async def api(request: Request):
+    form = dict(parse_qsl((await request.body()).decode(), keep_blank_values=True))
+    content = form.get("content", "")
+    is_import = content == "record" and "data" in form
+    name = "importRecords" if is_import else content
+    calls[name] = calls.get(name, 0) + 1
+
+    delay = SIM_LATENCY_MS + random.uniform(0, SIM_JITTER_MS)
+    if delay:
+        await asyncio.sleep(delay / 1000)
+
+    if content == "metadata":
+        wanted = set(_array(form, "fields"))
+        forms = set(_array(form, "forms"))
+        meta = [f for f in project.metadata
+                if (not wanted and not forms) or f["field_name"] in wanted or f["form_name"] in forms]
+        return JSONResponse(meta)
+    if content == "record":
+        if is_import:
+            status, body = project.import_records(form)
+            return JSONResponse(body, status_code=status)
+        return JSONResponse(project.export_records(form))
+    if content == "dag":
+        return JSONResponse(DAGS)
+    if content == "event":
+        if not project.events:
+            return JSONResponse({"error": "You cannot export events for classic projects"}, status_code=400)
+        return JSONResponse(project.events)
+    if content == "log":
+        return JSONResponse([])
+    if content == "project":
+        return JSONResponse({"project_id": 1, "project_title": "Simulated B4U project",
+                             "is_longitudinal": int(bool(project.events)), "record_autonumbering_enabled": 0})
+    return JSONResponse({"error": f"content '{content}' is not supported by the simulator"}, status_code=400)
+
+
+async def sim_stats(request: Request):
+    return JSONResponse({"records": len(project.records), "calls": calls})
+
+
+app = Starlette(routes=[
+    Route("/api/", api, methods=["POST"]),
+    Route("/api", api, methods=["POST"]),
+    Route("/_sim/stats", sim_stats, methods=["GET"]),
+])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--records", type=int, default=SIM_RECORDS)
+    parser.add_argument("--repeats", type=int, default=SIM_REPEATS)
+    parser.add_argument("--fields", type=int, default=SIM_FIELDS)
+    parser.add_argument("--longitudinal", action="store_true", default=SIM_LONGITUDINAL)
+    parser.add_argument("--latency-ms", type=float, default=SIM_LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=SIM_JITTER_MS)
+    args = parser.parse_args()
+
+    SIM_LATENCY_MS, SIM_JITTER_MS = args.latency_ms, args.jitter_ms
+    project = SimProject(args.records, args.repeats, args.fields, args.longitudinal, SIM_SEED)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
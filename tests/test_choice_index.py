@@ -0,0 +1,43 @@
+"""Compiled choice lookups and one-pass decoding of raw exports."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from choice_index import ChoiceIndex, checkbox_column  # noqa: E402
+
+METADATA = [
+    {"field_name": "record_id", "field_type": "text", "select_choices_or_calculations": ""},
+    {"field_name": "health_status", "field_type": "radio",
+     "select_choices_or_calculations": "1, Healthy | 2, Non-healthy"},
+    {"field_name": "symptoms", "field_type": "checkbox",
+     "select_choices_or_calculations": "1, Fatigue | 2, Pain | -9, Unknown | A, Other"},
+    {"field_name": "consent", "field_type": "yesno", "select_choices_or_calculations": ""},
+]
+
+
+def test_lookups():
+    index = ChoiceIndex(METADATA)
+    assert index.label("health_status", 2) == "Non-healthy"
+    assert index.code("health_status", "non_healthy") == "2"
+    assert index.choice_map("consent") == {"1": "Yes", "0": "No"}
+    assert index.get("record_id") is None
+
+
+def test_checkbox_columns_follow_redcap_naming():
+    index = ChoiceIndex(METADATA)
+    assert checkbox_column("symptoms", "-9") == "symptoms____9"
+    assert index.checkbox_columns["symptoms___a"] == ("symptoms", "A", "Other")
+    assert set(index.checkbox_columns) == {"symptoms___1", "symptoms___2", "symptoms____9", "symptoms___a"}
+
+
+def test_decode_record():
+    index = ChoiceIndex(METADATA)
+    row = {"record_id": "EL0001", "health_status": "1", "consent": "",
+           "symptoms___1": "1", "symptoms___2": "0", "symptoms____9": "0", "symptoms___a": "1"}
+    assert index.decode_record(row) == {
+        "record_id": "EL0001",
+        "health_status": "Healthy",
+        "consent": "",
+        "symptoms": ["Fatigue", "Other"],
+    }
@@ -0,0 +1,76 @@
+"""How bulk enrolment batches react to REDCap validation errors, outages and partial imports."""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from redcap_async import RedcapApiError  # noqa: E402
+from utils import _import_batch  # noqa: E402
+
+
+class FakeClient:
+    """import_records stand-in: `respond(ids)` returns the content or raises."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+
+    async def import_records(self, records, **kwargs):
+        ids = [r["record_id"] for r in records]
+        self.calls.append(ids)
+        return self.respond(ids)
+
+
+def run(client, user_ids):
+    results = [{"row": i, "userId": uid, "status": "pending", "record_id": None, "message": None}
+               for i, uid in enumerate(user_ids)]
+    batch = [(i, {"record_id": uid}) for i, uid in enumerate(user_ids)]
+    asyncio.run(_import_batch(client, batch, results))
+    return results
+
+
+def test_validation_error_splits_batch_per_record():
+    def respond(ids):
+        if "BAD" in ids:
+            raise RedcapApiError("REDCap error (400): invalid value", 400)
+        return ids
+
+    client = FakeClient(respond)
+    results = run(client, ["A", "BAD", "C"])
+    assert client.calls == [["A", "BAD", "C"], ["A"], ["BAD"], ["C"]]
+    assert [r["status"] for r in results] == ["success", "error", "success"]
+    assert "invalid value" in results[1]["message"]
+
+
+def test_server_error_fails_batch_without_splitting():
+    def respond(ids):
+        raise RedcapApiError("REDCap error (503): unavailable", 503)
+
+    client = FakeClient(respond)
+    results = run(client, ["A", "B", "C"])
+    assert client.calls == [["A", "B", "C"]]
+    assert all(r["status"] == "error" and "503" in r["message"] for r in results)
+
+
+def test_transport_error_fails_batch_without_splitting():
+    def respond(ids):
+        raise RedcapApiError("REDCap request failed: ConnectError()")
+
+    client = FakeClient(respond)
+    results = run(client, ["A", "B"])
+    assert client.calls == [["A", "B"]]
+    assert [r["status"] for r in results] == ["error", "error"]
+
+
+def test_rows_missing_from_returned_ids_are_errors():
+    client = FakeClient(lambda ids: [i for i in ids if i != "B"])
+    results = run(client, ["A", "B", "C"])
+    assert [r["status"] for r in results] == ["success", "error", "success"]
+    assert results[0]["record_id"] == "A" and results[1]["record_id"] is None
+
+
+def test_returned_ids_wrapped_in_objects():
+    client = FakeClient(lambda ids: [{"id": i} for i in ids])
+    results = run(client, ["A", "B"])
+    assert [r["status"] for r in results] == ["success", "success"]
@@ -0,0 +1,110 @@
+"""Per-item outcomes and retries of the batched response ingestor."""
+import os
+import sys
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError, WriteError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import ingest  # noqa: E402
+from ingest import ResponseIngestor  # noqa: E402
+
+
+class Result:
+    def __init__(self, upserted_ids):
+        self.upserted_ids = upserted_ids
+
+
+class FakeCollection:
+    """bulk_write stand-in: `respond(record_ids, call)` returns upserted indexes or raises."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+
+    async def bulk_write(self, ops, ordered=True):
+        ids = [op._filter["record_id"] for op in ops]
+        self.calls.append(ids)
+        return Result({i: f"oid{i}" for i in self.respond(ids, len(self.calls))})
+
+
+def bulk_error(write_errors, upserted=()):
+    return BulkWriteError({"writeErrors": write_errors, "upserted": [{"index": i, "_id": i} for i in upserted],
+                           "writeConcernErrors": [], "nInserted": 0, "nUpserted": len(upserted)})
+
+
+def ingest_all(collection, updates):
+    async def scenario():
+        ingestor = ResponseIngestor(collection, batch_size=len(updates), flush_interval=0.05)
+        await ingestor.start()
+        futures = [ingestor.submit(rid, {"record_id": rid}, update) for rid, update in updates]
+        outcomes = await asyncio.gather(*futures, return_exceptions=True)
+        await ingestor.stop()
+        return outcomes, ingestor
+
+    return asyncio.run(scenario())
+
+
+UPDATE = {"$set": {"x": 1}}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_RETRY_BASE_S", 0)
+
+
+def test_write_errors_resolve_their_own_items():
+    def respond(ids, call):
+        raise bulk_error([{"index": 1, "code": 121, "errmsg": "Document failed validation"}], upserted=[0])
+
+    collection = FakeCollection(respond)
+    outcomes, ingestor = ingest_all(collection, [("A", UPDATE), ("B", UPDATE), ("C", UPDATE)])
+    assert outcomes[0] == "inserted" and outcomes[2] == "updated"
+    assert isinstance(outcomes[1], WriteError) and outcomes[1].code == 121
+    assert collection.calls == [["A", "B", "C"]]
+    assert ingestor.errors == 1
+
+
+def test_transient_write_errors_are_retried_alone():
+    def respond(ids, call):
+        if call == 1:
+            raise bulk_error([{"index": 1, "code": 11000, "errmsg": "E11000 duplicate key"}], upserted=[0])
+        return []
+
+    collection = FakeCollection(respond)
+    outcomes, ingestor = ingest_all(collection, [("A", UPDATE), ("B", UPDATE), ("C", UPDATE)])
+    assert outcomes == ["inserted", "updated", "updated"]
+    assert collection.calls == [["A", "B", "C"], ["B"]]
+    assert ingestor.retries == 1 and ingestor.errors == 0
+
+
+def test_transient_retries_are_bounded():
+    def respond(ids, call):
+        raise bulk_error([{"index": 0, "code": 11600, "errmsg": "interrupted at shutdown"}])
+
+    collection = FakeCollection(respond)
+    outcomes, _ = ingest_all(collection, [("A", UPDATE)])
+    assert isinstance(outcomes[0], WriteError)
+    assert len(collection.calls) == ingest.INGEST_MAX_RETRIES + 1
+
+
+def test_network_error_retries_the_whole_batch():
+    def respond(ids, call):
+        if call == 1:
+            raise AutoReconnect("primary stepped down")
+        return [0]
+
+    collection = FakeCollection(respond)
+    outcomes, _ = ingest_all(collection, [("A", UPDATE), ("B", UPDATE)])
+    assert outcomes == ["inserted", "updated"]
+    assert collection.calls == [["A", "B"], ["A", "B"]]
+
+
+def test_malformed_update_fails_alone_and_flusher_survives():
+    collection = FakeCollection(lambda ids, call: [])
+    outcomes, ingestor = ingest_all(collection, [("A", UPDATE), ("B", "not a mapping"), ("C", UPDATE)])
+    assert outcomes[0] == outcomes[2] == "updated"
+    assert isinstance(outcomes[1], TypeError)
+    assert collection.calls == [["A", "C"]]
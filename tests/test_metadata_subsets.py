@@ -0,0 +1,39 @@
+"""Field/form selections memoized on a MetadataEntry."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import metadata_cache  # noqa: E402
+from metadata_cache import MetadataEntry  # noqa: E402
+
+METADATA = [{"field_name": "record_id", "form_name": "enrolment", "field_label": "Record ID"}] + [
+    {"field_name": f"q{i}", "form_name": "weekly_survey", "field_label": f"Question {i}"} for i in range(10)]
+
+
+def test_selection_is_memoized_regardless_of_order():
+    entry = MetadataEntry(METADATA)
+    subset = entry.restrict(fields=["q2", "q1"])
+    assert entry.restrict(fields=["q1", "q2", "q1"]) is subset
+    assert list(subset.fields) == ["record_id", "q1", "q2"]
+
+
+def test_memo_is_bounded_lru(monkeypatch):
+    monkeypatch.setattr(metadata_cache, "METADATA_SUBSETS_MAX", 3)
+    entry = MetadataEntry(METADATA)
+    first = entry.restrict(fields=["q0"])
+    for i in range(1, 4):
+        entry.restrict(fields=[f"q{i}"])
+        entry.restrict(fields=["q0"])  # keep the first selection recently used
+    assert len(entry._subsets) == 3
+    assert entry.restrict(fields=["q0"]) is first
+    assert (("q1",), ()) not in entry._subsets
+
+
+def test_unknown_names_are_rejected_and_not_memoized():
+    entry = MetadataEntry(METADATA)
+    with pytest.raises(ValueError, match="nope"):
+        entry.restrict(fields=["nope"])
+    assert not entry._subsets
@@ -0,0 +1,91 @@
+"""Circuit breaker and retry accounting of the outbound delivery engine."""
+import os
+import sys
+import asyncio
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import outbound  # noqa: E402
+from outbound import CircuitBreaker, CircuitOpenError, DeliveryEngine  # noqa: E402
+
+URL = "http://upstream/users/1/status/today"
+
+
+def make_engine(handler, max_retries=0, threshold=2, reset_after=0.05) -> DeliveryEngine:
+    engine = DeliveryEngine(httpx.AsyncClient(transport=httpx.MockTransport(handler)), max_retries=max_retries)
+    engine._target(URL).breaker = CircuitBreaker(threshold=threshold, reset_after=reset_after)
+    return engine
+
+
+def test_open_half_open_closed():
+    status = {"code": 503}
+
+    async def scenario():
+        engine = make_engine(lambda request: httpx.Response(status["code"]))
+        breaker = engine._target(URL).breaker
+        for _ in range(2):
+            assert (await engine.request("GET", URL)).status_code == 503
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await engine.request("GET", URL)
+
+        await asyncio.sleep(0.06)
+        assert breaker.state == "half-open"
+        status["code"] = 200
+        assert (await engine.request("GET", URL)).status_code == 200
+        assert breaker.state == "closed" and breaker.failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_retries_count_as_one_failure(monkeypatch):
+    monkeypatch.setattr(outbound, "_backoff", lambda attempt, retry_after=None: 0)
+
+    async def scenario():
+        engine = make_engine(lambda request: httpx.Response(503), max_retries=4, threshold=2)
+        await engine.request("GET", URL)
+        breaker = engine._target(URL).breaker
+        assert breaker.failures == 1 and breaker.state == "closed"
+        assert engine.stats()["http://upstream"]["sent"] == 5
+
+    asyncio.run(scenario())
+
+
+def test_single_probe_and_release_on_cancel():
+    async def scenario():
+        probe_started = asyncio.Event()
+
+        async def hang(request):
+            probe_started.set()
+            await asyncio.sleep(10)
+
+        engine = make_engine(hang)
+        breaker = engine._target(URL).breaker
+        breaker.failures, breaker.opened_at = 2, 0.0  # opened long ago: half-open
+
+        probe = asyncio.create_task(engine.request("GET", URL))
+        await probe_started.wait()
+        # Only the one probe may be in flight
+        with pytest.raises(CircuitOpenError):
+            await engine.request("GET", URL)
+
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        assert breaker.state == "half-open"
+        assert breaker.allow() == (True, True)
+
+    asyncio.run(scenario())
+
+
+def test_allow_reports_the_claimed_probe():
+    breaker = CircuitBreaker(threshold=1, reset_after=0)
+    assert breaker.allow() == (True, False)
+    breaker.record_failure()
+    # reset_after=0: half-open immediately, whoever asks first claims the probe
+    assert breaker.allow() == (True, True)
+    assert breaker.allow() == (False, False)
+    breaker.release_probe()
+    assert breaker.allow() == (True, True)
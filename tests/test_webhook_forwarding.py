@@ -0,0 +1,61 @@
+"""Forwarding failures must reach the webhook queue (retry on 5xx/429, dead-letter on 4xx)."""
+import os
+import sys
+import asyncio
+
+import httpx
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import db  # noqa: E402
+import main  # noqa: E402
+import outbound  # noqa: E402
+from webhook_queue import DEAD, DONE, PENDING, WebhookQueue  # noqa: E402
+
+
+class FakeStore:
+    async def get_category(self, user_id):
+        return "healthy"
+
+
+PAYLOAD = {"record_id": "EL0001", "instrument": "functionality_appreciation_scale_fas",
+           "timestamp": "2025-10-13T09:58:04Z"}
+
+
+def run_job(tmp_path, monkeypatch, upstream_status):
+    monkeypatch.setattr(main, "FORWARD_ENABLED", True)
+    monkeypatch.setattr(main, "FORWARD_URL", "http://upstream")
+    monkeypatch.setattr(db, "mongo", FakeStore())
+    transport = httpx.MockTransport(lambda request: httpx.Response(upstream_status, json={}))
+    monkeypatch.setattr(outbound, "engine", outbound.DeliveryEngine(httpx.AsyncClient(transport=transport),
+                                                                    max_retries=0))
+
+    async def scenario():
+        queue = WebhookQueue(str(tmp_path / "queue.db"))
+        await queue.enqueue(PAYLOAD)
+        await queue.start(main.handle_completed_user, workers=1)
+        try:
+            for _ in range(200):
+                row = queue._conn.execute("SELECT status, attempts, last_error FROM webhook_jobs").fetchone()
+                if row["attempts"] and row["status"] != "processing":
+                    return dict(row)
+                await asyncio.sleep(0.01)
+            raise AssertionError(f"job not processed: {dict(row)}")
+        finally:
+            await queue.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_upstream_5xx_is_retried(tmp_path, monkeypatch):
+    job = run_job(tmp_path, monkeypatch, 503)
+    assert job["status"] == PENDING and "503" in job["last_error"]
+
+
+def test_upstream_4xx_is_dead_lettered(tmp_path, monkeypatch):
+    job = run_job(tmp_path, monkeypatch, 404)
+    assert job["status"] == DEAD
+
+
+def test_upstream_success_completes(tmp_path, monkeypatch):
+    job = run_job(tmp_path, monkeypatch, 200)
+    assert job["status"] == DONE, job["last_error"]
@@ -0,0 +1,92 @@
+"""Lease ownership of claimed webhook jobs across processes sharing one queue database."""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from webhook_queue import DONE, PENDING, PROCESSING, WebhookQueue  # noqa: E402
+
+PAYLOAD = {"record_id": "EL0001", "instrument": "fas", "timestamp": "2025-10-13T09:58:04Z"}
+
+
+def status(queue, job_id):
+    return dict(queue._conn.execute("SELECT status, owner, attempts FROM webhook_jobs WHERE id = ?",
+                                    (job_id,)).fetchone())
+
+
+def test_live_lease_is_not_recovered_by_another_process(tmp_path):
+    path = str(tmp_path / "queue.db")
+    a, b = WebhookQueue(path, lease=60), WebhookQueue(path, lease=60)
+    job_id, _ = a._enqueue(PAYLOAD)
+    assert a._claim()["id"] == job_id
+
+    assert b._recover() == 0
+    assert b._claim() is None
+    assert status(b, job_id) == {"status": PROCESSING, "owner": a.owner, "attempts": 1}
+    assert a._finish(job_id, {"ok": True})
+    assert status(b, job_id)["status"] == DONE
+
+
+def test_expired_lease_is_reclaimed_and_stale_owner_cannot_settle(tmp_path):
+    path = str(tmp_path / "queue.db")
+    a, b = WebhookQueue(path, lease=0.01), WebhookQueue(path, lease=60)
+    job_id, _ = a._enqueue(PAYLOAD)
+    a._claim()
+    time.sleep(0.02)
+
+    assert b._claim()["id"] == job_id
+    assert status(b, job_id) == {"status": PROCESSING, "owner": b.owner, "attempts": 2}
+    assert not a._extend(job_id)
+    assert not a._finish(job_id, {"ok": True})
+    assert a._fail(job_id, 2, "late", permanent=False) is None
+    assert b._fail(job_id, 2, "boom", permanent=False) == PENDING
+
+
+def test_heartbeat_keeps_a_slow_job_leased(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "queue.db")
+        a, b = WebhookQueue(path, lease=0.05), WebhookQueue(path, lease=0.05)
+        release = asyncio.Event()
+
+        async def slow(payload):
+            await release.wait()
+            return {"ok": True}
+
+        job_id, _ = await a.enqueue(PAYLOAD)
+        await a.start(slow, workers=1)
+        try:
+            await asyncio.sleep(0.2)  # several lease periods
+            assert b._claim() is None
+            release.set()
+            for _ in range(100):
+                if status(b, job_id)["status"] == DONE:
+                    break
+                await asyncio.sleep(0.01)
+            assert status(b, job_id) == {"status": DONE, "owner": None, "attempts": 1}
+        finally:
+            await a.stop()
+
+    asyncio.run(scenario())
+
+
+def test_queue_created_before_leases_is_migrated(tmp_path):
+    path = str(tmp_path / "queue.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE webhook_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, idem_key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL,
+            last_error TEXT, result TEXT);
+        INSERT INTO webhook_jobs (idem_key, payload, status, attempts, available_at, created_at, updated_at)
+            VALUES ('k', '{}', 'processing', 1, 0, 0, 0);
+    """)
+    conn.close()
+
+    queue = WebhookQueue(path)
+    # Claimed by a pre-lease worker: no lease, so it counts as expired
+    assert queue._recover() == 1
+    job_id = queue._claim()["id"]
+    assert status(queue, job_id) == {"status": PROCESSING, "owner": queue.owner, "attempts": 2}